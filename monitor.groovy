@@ -95,6 +95,23 @@ def installed() {
 
 def updated() {
     log.debug "Updated with settings: ${settings}"
+    // Selected things may have changed.
+    subscribeAll()
+}
+
+/**
+ * Subscribe to all attributes of all selected things if pushing is enabled
+ */
+def subscribeAll() {
+    unsubscribe()
+    if(!state.pushUrl){
+        return
+    }
+    getThings("all").each { thing ->
+        thing.supportedAttributes.each {
+            subscribe(thing, it.name, handlerEvent)
+        }
+    }
 }
 
 /**
@@ -169,6 +186,10 @@ def handlerURL() {
             return handlerEvents()
         case "states":
             return handlerStates()
+        case "batchStates":
+            return handlerBatchStates()
+        case "push":
+            return handlerPush()
         default:
             log.debug( $/handlerURL() received invalid $$params.function "$params.function"/$ )
             return []
@@ -226,6 +247,7 @@ def handlerEvents() {
  * Retrieve up to $params.max $params.state states since $params.since from sensor with ID $params.thingID
  * 
  * since is seconds since epoch as float or int, defaults to 7 days ago
+ * until is seconds since epoch as float or int, defaults to now
  * max defaults to 1000
  */
 def handlerStates(){
@@ -245,10 +267,109 @@ def handlerStates(){
     def max = params.max ? params.max.toInteger() : 1000
     max = 0 < max && max < 1000 ? max : 1000
     log.debug "handlerStates().max: ${max}"
-    getThing(params.thing_id).statesSince(params.state, since, [max: max]).collect([]) {[
+    def thing = getThing(params.thing_id)
+    def states
+    if(params.until){
+        def until = new Date(Math.round(params.until.toFloat() * 1000))
+        log.debug "handlerStates().until: ${until}"
+        states = thing.statesBetween(params.state, since, until, [max: max])
+    } else {
+        states = thing.statesSince(params.state, since, [max: max])
+    }
+    states.collect([]) {[
         state: params.state,
         date:  it.date,
         value: it.value,
     ]}
 }
 
+
+/**
+ * Retrieve states of many things at once. $params.series is a JSON list of objects
+ * with thing_id, state and since (seconds since epoch or null for 7 days ago).
+ * Returns one object per requested series with thing_id, state and up to
+ * $params.max states, newest first. max defaults to 1000
+ */
+def handlerBatchStates(){
+    def series = params.series ? new groovy.json.JsonSlurper().parseText(params.series) : []
+    def max = params.max ? params.max.toInteger() : 1000
+    max = 0 < max && max < 1000 ? max : 1000
+    log.debug "handlerBatchStates() ${series.size()} series, max ${max}"
+    // Look up things once instead of once per series as getThing() would.
+    def things = [:]
+    getThings("all").each {
+        things[it.id] = it
+    }
+    series.collect([]) { request ->
+        def thing = things[request.thing_id]
+        def since = request.since ? new Date(Math.round(request.since.toFloat() * 1000)) : new Date() - 7
+        def states = thing ? thing.statesSince(request.state, since, [max: max]) : []
+        [
+            thing_id: request.thing_id,
+            state:    request.state,
+            states:   states.collect([]) {[
+                state: request.state,
+                date:  it.date,
+                value: it.value,
+            ]},
+        ]
+    }
+}
+
+/**
+ * Push events of selected things to $params.url, sent with header X-Monitor-Key
+ * set to $params.key, instead of waiting to be polled. An empty url stops pushing.
+ */
+def handlerPush(){
+    state.pushUrl = params.url ?: null
+    state.pushKey = params.key ?: null
+    atomicState.pending = []
+    subscribeAll()
+    log.debug "handlerPush().pushUrl: ${state.pushUrl}"
+    return [push: state.pushUrl != null]
+}
+
+/**
+ * Collect an event to push, sending pending events once 100 are collected or a
+ * minute after the first one. Pending events are kept in atomicState, which
+ * is written immediately, since handlers of concurrent events run at once.
+ */
+def handlerEvent(evt){
+    def pending = atomicState.pending ?: []
+    pending << [
+        thing_id: evt.deviceId,
+        state:    evt.name,
+        date:     evt.date.format("yyyy-MM-dd'T'HH:mm:ss'Z'", TimeZone.getTimeZone("UTC")),
+        value:    evt.value,
+    ]
+    atomicState.pending = pending
+    if(pending.size() >= 100){
+        pushEvents()
+    } else if(pending.size() == 1){
+        runIn(60, pushEvents)
+    }
+}
+
+/**
+ * POST pending events to state.pushUrl. Events that fail to send are dropped;
+ * the monitor polls from the newest state it polled, not the newest pushed,
+ * so polling picks them up later.
+ */
+def pushEvents(){
+    def pending = atomicState.pending ?: []
+    atomicState.pending = []
+    if(!pending || !state.pushUrl){
+        return
+    }
+    try {
+        httpPostJson(
+            uri:     state.pushUrl,
+            headers: ["X-Monitor-Key": state.pushKey],
+            body:    [events: pending],
+        ) { resp ->
+            log.debug "pushEvents() sent ${pending.size()} events: ${resp.status}"
+        }
+    } catch (e) {
+        log.debug "pushEvents() failed: ${e}"
+    }
+}
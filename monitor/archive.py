@@ -0,0 +1,274 @@
+"""Cold archive of old raw states in append-only, memory mappable files on
+disk. States moved here by `retention.py` are removed from MongoDB, but reads
+through storage.store() still see them.
+
+ARCHIVE_DIR is the `archive` directory next to this module, whatever the
+working directory. Every process reading states, such as the web app, the
+cron tasks and all poller nodes, must see the same ARCHIVE_DIR, so with
+several hosts it has to be on a shared filesystem; otherwise archived states
+are missing from their reads.
+
+Each series has a directory `ARCHIVE_DIR/<thing_id>/<state>/` holding segments
+covering consecutive date ranges. A segment `<since>-<until>`, named by its
+range in milliseconds since epoch, is made of NumPy `.npy` files:
+
+    <since>-<until>.dates.npy: int64 milliseconds since epoch, sorted
+    <since>-<until>.values.npy: float64 values if all values are floats,
+        int64 values if all are integers, and otherwise int64 indexes into
+        the labels
+    <since>-<until>.labels.json: present unless values are all floats or all
+        integers, the list of distinct values, so strings, booleans and
+        nulls keep their types
+
+The dates file is written last, so a segment without one is incomplete and
+ignored. Segments are never modified; writing a segment again replaces it
+whole.
+
+"""
+import logging
+log = logging.getLogger(__name__)
+log.debug("archive.py loaded")
+
+import heapq
+import json
+import os
+import urllib
+from datetime import datetime, timedelta
+import numpy
+
+
+# directory holding archived states
+ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "archive")
+DATES_SUFFIX = ".dates.npy"
+EPOCH = datetime(1970, 1, 1)
+
+
+def milliseconds(date):
+    """Return milliseconds since epoch of a naive UTC datetime."""
+    return int((date - EPOCH).total_seconds() * 1000)
+
+
+def _date(value):
+    """Return naive UTC datetime of milliseconds since epoch."""
+    return EPOCH + timedelta(milliseconds=int(value))
+
+
+def _quote(name):
+    """Return name safe to use as a file name."""
+    return urllib.quote(name.encode("utf-8"), safe="")
+
+
+def _unquote(name):
+    return urllib.unquote(name).decode("utf-8")
+
+
+class ColdStore(object):
+    """Archived states of all series in a directory."""
+
+    def __init__(self, directory=ARCHIVE_DIR):
+        self.directory = directory
+
+    def _path(self, thing_id, state=None):
+        """Return directory of a series, or of a thing if state is None."""
+        if state is None:
+            return os.path.join(self.directory, _quote(thing_id))
+        return os.path.join(self.directory, _quote(thing_id), _quote(state))
+
+    def _states(self, thing_id):
+        """Return states of a thing with archived segments."""
+        path = self._path(thing_id)
+        if not os.path.isdir(path):
+            return []
+        return sorted(_unquote(x) for x in os.listdir(path))
+
+    def _segments(self, thing_id, state):
+        """Return sorted `(since, until, prefix)` of complete segments, with
+        dates in milliseconds."""
+        path = self._path(thing_id, state)
+        if not os.path.isdir(path):
+            return []
+        segments = []
+        for name in os.listdir(path):
+            if not name.endswith(DATES_SUFFIX):
+                continue
+            since, until = name[:-len(DATES_SUFFIX)].split("-")
+            segments.append((
+                int(since),
+                int(until),
+                os.path.join(path, name[:-len(DATES_SUFFIX)]),
+            ))
+        return sorted(segments)
+
+    def empty(self, thing_id, state=None):
+        """Return whether nothing is archived for a thing or series."""
+        if state is None:
+            return not self._states(thing_id)
+        return not self._segments(thing_id, state)
+
+    def horizon(self, thing_id, state):
+        """Return end of the archived range of a series.
+
+        Returns:
+            datetime before which all states are archived, or None if none
+            are.
+
+        """
+        segments = self._segments(thing_id, state)
+        if not segments:
+            return None
+        return _date(max(x[1] for x in segments))
+
+    def write(self, thing_id, state, since, until, states):
+        """Write a segment of states.
+
+        Args:
+            thing_id (str): ID of the thing the states belong to.
+            state (str): Type of the states.
+            since (datetime): Start of the range covered.
+            until (datetime): End of the range covered.
+            states (list): States with `date` and `value` keys, sorted by date.
+
+        """
+        path = self._path(thing_id, state)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        prefix = os.path.join(path, "{0}-{1}".format(
+            milliseconds(since),
+            milliseconds(until),
+        ))
+        dates = numpy.array(
+            [milliseconds(x["date"]) for x in states],
+            dtype="<i8",
+        )
+        raw = [x["value"] for x in states]
+        labels = None
+        if all(type(x) is float for x in raw):
+            values = numpy.array(raw, dtype="<f8")
+        elif all(type(x) in (int, long) for x in raw):
+            values = numpy.array(raw, dtype="<i8")
+        else:
+            labels = []
+            codes = {}
+            for value in raw:
+                key = json.dumps(value, sort_keys=True)
+                if key not in codes:
+                    codes[key] = len(labels)
+                    labels.append(value)
+            values = numpy.array(
+                [codes[json.dumps(x, sort_keys=True)] for x in raw],
+                dtype="<i8",
+            )
+        numpy.save(prefix + ".values.npy", values)
+        if labels is not None:
+            with open(prefix + ".labels.json", "w") as f:
+                json.dump(labels, f)
+        elif os.path.exists(prefix + ".labels.json"):
+            os.remove(prefix + ".labels.json")
+        # Write dates last and atomically, marking the segment complete.
+        numpy.save(prefix + ".tmp.npy", dates)
+        os.rename(prefix + ".tmp.npy", prefix + DATES_SUFFIX)
+        log.debug(
+            "write: Archived {0} states of {1} {2}."
+            .format(len(states), thing_id, state)
+        )
+
+    def _read(self, thing_id, state, prefix, since=None, until=None):
+        """Yield states of one segment within a date range."""
+        dates = numpy.load(prefix + DATES_SUFFIX, mmap_mode="r")
+        values = numpy.load(prefix + ".values.npy", mmap_mode="r")
+        labels = None
+        if os.path.exists(prefix + ".labels.json"):
+            with open(prefix + ".labels.json") as f:
+                labels = json.load(f)
+        first = 0
+        last = len(dates)
+        if since is not None:
+            first = numpy.searchsorted(dates, milliseconds(since), "left")
+        if until is not None:
+            last = numpy.searchsorted(dates, milliseconds(until), "left")
+        for i in xrange(first, last):
+            if labels is not None:
+                value = labels[int(values[i])]
+            elif values.dtype.kind == "i":
+                value = int(values[i])
+            else:
+                value = float(values[i])
+            yield {
+                "thing_id": thing_id,
+                "state":    state,
+                "date":     _date(dates[i]),
+                "value":    value,
+            }
+
+    def _series(self, thing_id, state, since=None, until=None):
+        """Yield archived states of one series sorted by date."""
+        for first, last, prefix in self._segments(thing_id, state):
+            if since is not None and last <= milliseconds(since):
+                continue
+            if until is not None and first >= milliseconds(until):
+                continue
+            for item in self._read(thing_id, state, prefix, since, until):
+                yield item
+
+    def find(self, thing_id, state=None, since=None, until=None):
+        """Get archived states of a thing sorted by date.
+
+        Args:
+            thing_id (str): Limit to the thing with this ID.
+            state (Optional[str]): Limit to this type of state.
+            since (Optional[datetime]): Limit to states on or after this time.
+            until (Optional[datetime]): Limit to states before this time.
+        Returns:
+            Iterable of states with `thing_id`, `state`, `date` and `value`.
+
+        """
+        if state is not None:
+            return self._series(thing_id, state, since, until)
+        return merge([
+            self._series(thing_id, x, since, until)
+            for x in self._states(thing_id)
+        ])
+
+    def scan(self):
+        """Iterate over all archived states in no particular order."""
+        if not os.path.isdir(self.directory):
+            return
+        for thing in os.listdir(self.directory):
+            thing_id = _unquote(thing)
+            for state in self._states(thing_id):
+                for item in self._series(thing_id, state):
+                    yield item
+
+    def date_range(self, thing_id, state=None):
+        """Get dates of first and last archived states of a thing.
+
+        Returns:
+            Dictionary with `min` and `max` keys, or None if none archived.
+
+        """
+        states = [state] if state is not None else self._states(thing_id)
+        result = None
+        for name in states:
+            for first, last, prefix in self._segments(thing_id, name):
+                dates = numpy.load(prefix + DATES_SUFFIX, mmap_mode="r")
+                if not len(dates):
+                    continue
+                low, high = _date(dates[0]), _date(dates[-1])
+                if result is None:
+                    result = {"min": low, "max": high}
+                else:
+                    result["min"] = min(result["min"], low)
+                    result["max"] = max(result["max"], high)
+        return result
+
+
+def _decorate(iterable, rank):
+    """Yield states as tuples sorting by date, then by iterable and order."""
+    for n, item in enumerate(iterable):
+        yield item["date"], rank, n, item
+
+
+def merge(iterables):
+    """Merge iterables of states each sorted by date into one sorted by date."""
+    decorated = [_decorate(x, i) for i, x in enumerate(iterables)]
+    return (x[3] for x in heapq.merge(*decorated))
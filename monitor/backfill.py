@@ -0,0 +1,120 @@
+"""Backfill of historical states. The requested history of every series of an
+account is split into independent time slices, each recorded in the
+`backfills` collection. Slices are fetched in parallel within the account's
+rate budget, and each slice checkpoints how far it got after every page, so
+an interrupted run resumes where it stopped when run again.
+
+"""
+import logging
+log = logging.getLogger(__name__)
+log.debug("backfill.py loaded")
+
+from datetime import datetime, timedelta
+import poller
+import smartthings
+
+
+SLICE_DAYS = 1 # length of each independently fetched slice
+
+
+def plan(token, thing_id, state, start, end, slice_days=SLICE_DAYS):
+    """Record slices covering a window of one series. Slices that are
+    already recorded keep their progress.
+
+    Args:
+        token (str): Access token of the account.
+        thing_id (str): Thing to backfill.
+        state (str): Type of state to backfill.
+        start (datetime): Start of window.
+        end (datetime): End of window.
+        slice_days (Optional[int]): Length of each slice in days.
+    """
+    size = timedelta(days=slice_days)
+    slice_start = start
+    while slice_start < end:
+        slice_end = min(slice_start + size, end)
+        smartthings.db.backfills.update_one(
+            {
+                "token":    token,
+                "thing_id": thing_id,
+                "state":    state,
+                "start":    slice_start,
+            },
+            {"$setOnInsert": {
+                "end":    slice_end,
+                "cursor": slice_end, # slices are drained from the end down
+                "done":   False,
+            }},
+            upsert=True,
+        )
+        slice_start = slice_end
+
+
+def run_slice(st, item):
+    """Fetch all states of one slice, checkpointing after every page. The
+    slice is only marked done if every page was fetched; otherwise the next
+    run resumes it from its checkpoint.
+
+    Args:
+        st (smartthings.SmartThings): Client of the slice's account.
+        item (dict): Slice document from the `backfills` collection.
+    Returns:
+        Statistics from SmartThings.sync_states().
+
+    """
+
+    def _checkpoint(cursor):
+        smartthings.db.backfills.update_one(
+            {"_id": item["_id"]},
+            {"$set": {"cursor": cursor}},
+        )
+
+    stats = st.sync_states(
+        item["thing_id"],
+        item["state"],
+        since=item["start"],
+        until=item["cursor"],
+        progress=_checkpoint,
+    )
+    if stats["failed"]:
+        log.error(
+            "run_slice: {0} {1} from {2} left unfinished"
+            .format(item["thing_id"], item["state"], item["start"])
+        )
+        return stats
+    smartthings.db.backfills.update_one(
+        {"_id": item["_id"]},
+        {"$set": {"done": True}},
+    )
+    return stats
+
+
+def backfill(token, days, workers=1, slice_days=SLICE_DAYS):
+    """Backfill the last `days` days of every series of an account, resuming
+    any slices left unfinished by an earlier run.
+
+    Args:
+        token (str): Access token of the account.
+        days (int): Days of history to fetch.
+        workers (Optional[int]): Number of slices to fetch at once.
+        slice_days (Optional[int]): Length of each slice in days.
+    Returns:
+        Total number of new states stored.
+
+    """
+    st = smartthings.client(token)
+    st.budget = poller.budget(token)
+    end = datetime.utcnow()
+    start = end - timedelta(days=days)
+    # Align slices to midnight so reruns find the slices of earlier runs.
+    start = datetime(start.year, start.month, start.day)
+    for thing in st.things("all"):
+        for attribute in smartthings.attributes(thing):
+            plan(token, thing["id"], attribute, start, end, slice_days)
+    pending = list(smartthings.db.backfills.find({
+        "token": token,
+        "done":  False,
+    }))
+    log.debug("backfill: {0} slices pending".format(len(pending)))
+    results = poller.run(lambda item: run_slice(st, item), pending, workers)
+    return sum(x["inserted"] for x in results if x is not None)
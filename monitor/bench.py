@@ -0,0 +1,324 @@
+"""Offline benchmark of ingest and render performance. Runs a local HTTP server
+standing in for the `/endpoint` of the SmartApp in `monitor.groovy`, serving a
+synthetic fleet of accounts and devices, and drives `tasks.update_states` and
+`processor.results` against it using the `monitor_bench` database of the
+local mongod. Not needed for app; just used for development.
+
+    ../bin/python bench.py --accounts 4 --devices 20 --days 7
+
+The stand-in supports the `things`, `states` and `batchStates` functions with
+the same `since`, `until` and `max` semantics as the SmartApp, returning the
+newest states first, and enforces a per-account rate limit with `x-ratelimit-*`
+headers and HTTP 429 responses.
+
+With `--nodes N`, states are ingested instead by N processes sharing the
+polling through the work queue of `workqueue.py`, as separate poller nodes
+would.
+
+"""
+import os
+# The stand-in SmartApp is served over plain HTTP.
+os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
+
+import argparse
+import json
+import math
+import multiprocessing
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from datetime import datetime, timedelta
+
+import pymongo
+import ledger
+import indexes
+import poller
+import processor
+import smartthings
+import tasks
+import workqueue
+
+
+ATTRIBUTES = ["temperature", "humidity", "power"]
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+class Fleet(object):
+    """Synthetic accounts, each with devices reporting every attribute in
+    ATTRIBUTES at a fixed interval until `end`. States are computed on
+    demand rather than stored.
+    """
+
+    def __init__(self, accounts, devices, days, interval, limit, ttl):
+        self.tokens = ["bench-token-{0}".format(i) for i in range(accounts)]
+        self.devices = devices
+        self.interval = interval
+        self.end = datetime.utcnow().replace(microsecond=0)
+        self.start = self.end - timedelta(days=days)
+        self.limit = limit
+        self.ttl = ttl
+        self.calls = dict((token, 0) for token in self.tokens)
+        self.limited = dict((token, 0) for token in self.tokens)
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def things(self, token):
+        """Return thing list as returned by handlerThings()."""
+        return [
+            {
+                "id":    "{0}-thing-{1}".format(token, i),
+                "name":  "Sensor {0}".format(i),
+                "label": "Sensor {0}".format(i),
+                "capabilities": [
+                    {
+                        "name":       attribute,
+                        "attributes": [attribute],
+                        "commands":   [],
+                    }
+                    for attribute in ATTRIBUTES
+                ],
+            }
+            for i in range(self.devices)
+        ]
+
+    def states(self, thing_id, state, since, until, limit):
+        """Return states as returned by handlerStates(), newest first."""
+        first = int(math.ceil((since - self.start).total_seconds() / self.interval))
+        last = int((min(until, self.end) - self.start).total_seconds() // self.interval)
+        first = max(first, 0)
+        result = []
+        phase = hash(thing_id) % 360
+        for k in range(last, max(first, last - limit + 1) - 1, -1):
+            date = self.start + timedelta(seconds=k * self.interval)
+            value = 70 + 10 * math.sin(math.radians(phase + k))
+            result.append({
+                "state": state,
+                "date":  date.strftime(DATE_FORMAT),
+                "value": "{0:.1f}".format(value),
+            })
+        return result
+
+    def allow(self, token):
+        """Count a call and check it against the rate limit.
+
+        Returns:
+            Tuple of whether the call is allowed, calls in the current
+            window, and seconds until the window resets.
+
+        """
+        now = time.time()
+        with self._lock:
+            self.calls[token] += 1
+            start, count = self._windows.get(token, (now, 0))
+            if now - start >= self.ttl:
+                start, count = now, 0
+            count += 1
+            self._windows[token] = (start, count)
+            allowed = count <= self.limit
+            if not allowed:
+                self.limited[token] += 1
+            return allowed, count, int(math.ceil(self.ttl - (now - start)))
+
+
+def handler(fleet):
+    """Build request handler class serving a fleet."""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass # keep benchmark output readable
+
+        def _send(self, status, body, count, ttl):
+            body = json.dumps(body)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("x-ratelimit-limit", str(fleet.limit))
+            self.send_header("x-ratelimit-current", str(count))
+            self.send_header("x-ratelimit-ttl", str(ttl))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse.urlparse(self.path)
+            params = dict(urlparse.parse_qsl(url.query))
+            token = self.headers.get("Authorization", "").split(" ")[-1]
+            if url.path != "/endpoint" or token not in fleet.calls:
+                return self._send(404, [], 0, 0)
+            allowed, count, ttl = fleet.allow(token)
+            if not allowed:
+                return self._send(429, [], count, ttl)
+            function = params.get("function")
+            if function == "things":
+                body = fleet.things(token)
+            elif function == "states":
+                if "since" in params:
+                    since = datetime.utcfromtimestamp(float(params["since"]))
+                else:
+                    since = fleet.end - timedelta(days=7)
+                if "until" in params:
+                    until = datetime.utcfromtimestamp(float(params["until"]))
+                else:
+                    until = fleet.end
+                limit = int(params.get("max", 1000))
+                limit = limit if 0 < limit < 1000 else 1000
+                body = fleet.states(
+                    params["thing_id"],
+                    params["state"],
+                    since,
+                    until,
+                    limit,
+                )
+            elif function == "batchStates":
+                limit = int(params.get("max", 1000))
+                limit = limit if 0 < limit < 1000 else 1000
+                body = []
+                for request in json.loads(params.get("series", "[]")):
+                    if request["since"] is not None:
+                        since = datetime.utcfromtimestamp(float(request["since"]))
+                    else:
+                        since = fleet.end - timedelta(days=7)
+                    body.append({
+                        "thing_id": request["thing_id"],
+                        "state":    request["state"],
+                        "states":   fleet.states(
+                            request["thing_id"],
+                            request["state"],
+                            since,
+                            fleet.end,
+                            limit,
+                        ),
+                    })
+            else:
+                body = []
+            self._send(200, body, count, ttl)
+
+    return Handler
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def setup(fleet, port):
+    """Point the app at the benchmark database and register fleet accounts."""
+    pymongo.MongoClient().drop_database("monitor_bench")
+    connect()
+    indexes.ensure(smartthings.db)
+    for token in fleet.tokens:
+        smartthings.db.accounts.insert_one({
+            "token":      token,
+            "token_dict": {"access_token": token, "token_type": "Bearer"},
+            "endpoint":   "http://127.0.0.1:{0}/endpoint".format(port),
+        })
+
+
+def connect():
+    """Point the app at the benchmark database."""
+    smartthings.db = pymongo.MongoClient().monitor_bench
+    smartthings.calls = ledger.ledger(smartthings.db.calls)
+    smartthings._credentials["smartthings.json"] = {
+        "client_id":     "bench",
+        "client_secret": "bench",
+        "redirect_uri":  "http://127.0.0.1/connect",
+    }
+
+
+def node(threads):
+    """Work the queue in a child process until no job is due."""
+    # Connections of the parent must not be shared across fork.
+    connect()
+    workqueue.Worker(smartthings.db, threads).run(stop_when_idle=True)
+
+
+def percentile(values, fraction):
+    """Return value at a fraction of a sorted list."""
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monitor benchmark.")
+    parser.add_argument("--accounts", type=int, default=2)
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--days", type=int, default=3)
+    parser.add_argument("--interval", type=int, default=60,
+                        help="seconds between synthetic states")
+    parser.add_argument("--limit", type=int, default=250,
+                        help="API calls allowed per account per window")
+    parser.add_argument("--ttl", type=int, default=60,
+                        help="seconds in each rate limit window")
+    parser.add_argument("--account-workers", type=int,
+                        default=poller.ACCOUNT_WORKERS)
+    parser.add_argument("--series-workers", type=int,
+                        default=poller.SERIES_WORKERS)
+    parser.add_argument("--renders", type=int, default=20)
+    parser.add_argument("--nodes", type=int, default=0,
+                        help="poller processes sharing the work queue")
+    args = parser.parse_args()
+
+    fleet = Fleet(
+        args.accounts,
+        args.devices,
+        args.days,
+        args.interval,
+        args.limit,
+        args.ttl,
+    )
+    server = Server(("127.0.0.1", 0), handler(fleet))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    setup(fleet, server.server_address[1])
+
+    if args.nodes:
+        jobs = workqueue.discover(smartthings.db)
+        started = time.time()
+        nodes = [
+            multiprocessing.Process(
+                target=node,
+                args=(args.account_workers * args.series_workers,),
+            )
+            for i in range(args.nodes)
+        ]
+        for process in nodes:
+            process.start()
+        for process in nodes:
+            process.join()
+        elapsed = time.time() - started
+        print "{0} nodes polled {1} jobs in {2:.2f}s: {3:.1f} jobs/s.".format(
+            args.nodes, jobs, elapsed, jobs / elapsed)
+    else:
+        started = time.time()
+        poller.run(
+            lambda token: tasks.update_states(token, workers=args.series_workers),
+            fleet.tokens,
+            args.account_workers,
+        )
+        smartthings.calls.flush()
+        elapsed = time.time() - started
+    rows = sum(x["count"] for x in smartthings.db.series.find())
+    print "Ingested {0} states in {1:.2f}s: {2:.0f} states/s.".format(
+        rows, elapsed, rows / elapsed)
+    for token in fleet.tokens:
+        print "Account {0}: {1} API calls, {2} rate limited.".format(
+            token, fleet.calls[token], fleet.limited[token])
+
+    timings = []
+    for i in range(args.renders):
+        started = time.time()
+        processor.results(fleet.tokens[i % len(fleet.tokens)], fleet.start, fleet.end)
+        timings.append(time.time() - started)
+    timings.sort()
+    print "Rendered {0} pages: p50 {1:.3f}s, p90 {2:.3f}s, p99 {3:.3f}s.".format(
+        len(timings),
+        percentile(timings, 0.5),
+        percentile(timings, 0.9),
+        percentile(timings, 0.99),
+    )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
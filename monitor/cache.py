@@ -0,0 +1,108 @@
+"""In-process caches. `pages` holds computed data page results keyed by account
+token and date window. Entries are invalidated in process by SmartThings when
+it writes new things or states for a token, and across processes by comparing
+the account's `modified` date, which SmartThings updates on every write.
+Pages also expire after PAGE_TTL seconds, so computing them again checks
+whether their data is due for a refresh from the API, or in read only mode
+queues the refresh.
+
+`users` holds users looked up for `main.current_user()`, keyed by session ID.
+Since other processes cannot invalidate it, its entries expire after USER_TTL
+seconds, so a logout in another process takes effect within that time.
+
+"""
+import logging
+log = logging.getLogger(__name__)
+log.debug("cache.py loaded")
+
+import threading
+import time
+from collections import OrderedDict
+
+
+PAGE_CACHE_SIZE = 100 # data pages kept in memory
+PAGE_TTL = 300 # seconds a page is served before checking its data is fresh
+USER_CACHE_SIZE = 1000 # session users kept in memory
+USER_TTL = 5 # seconds a session's user is trusted, as after a logout elsewhere
+
+
+class LRUCache(object):
+    """Thread safe mapping holding at most `size` items, evicting the least
+    recently used item first. Keys must be tuples whose first item is the
+    account token, so entries can be invalidated per account.
+    """
+
+    def __init__(self, size):
+        """Set up empty cache.
+
+        Args:
+            size (int): Maximum number of items.
+        """
+        self._size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return item for key, or None if not cached."""
+        with self._lock:
+            value = self._items.pop(key, None)
+            if value is not None:
+                self._items[key] = value # mark as most recently used
+            return value
+
+    def set(self, key, value):
+        """Store item for key, evicting least recently used items if full."""
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self._size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, token):
+        """Remove all items belonging to an account.
+
+        Args:
+            token (str): Access token of the account.
+        """
+        with self._lock:
+            for key in [k for k in self._items if k[0] == token]:
+                del self._items[key]
+
+
+class TTLCache(LRUCache):
+    """LRUCache whose items expire `ttl` seconds after being set."""
+
+    def __init__(self, size, ttl):
+        """Set up empty cache.
+
+        Args:
+            size (int): Maximum number of items.
+            ttl (float): Seconds items are kept.
+        """
+        LRUCache.__init__(self, size)
+        self._ttl = ttl
+
+    def get(self, key):
+        """Return item for key, or None if not cached or expired."""
+        entry = LRUCache.get(self, key)
+        if entry is None or entry[1] < time.time():
+            return None
+        return entry[0]
+
+    def set(self, key, value):
+        """Store item for key, expiring in `ttl` seconds."""
+        LRUCache.set(self, key, (value, time.time() + self._ttl))
+
+
+pages = TTLCache(PAGE_CACHE_SIZE, PAGE_TTL)
+users = TTLCache(USER_CACHE_SIZE, USER_TTL)
+
+
+def invalidate(token):
+    """Remove all cached items belonging to an account.
+
+    Args:
+        token (str): Access token of the account.
+    """
+    log.debug("invalidate: {0}".format(token))
+    pages.invalidate(token)
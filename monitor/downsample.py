@@ -0,0 +1,83 @@
+"""Shape preserving downsampling of time series for charts. Charts cannot show
+more points than they are pixels wide, so series are reduced to about that many
+points before being sent to the browser.
+
+Points are chosen with Largest Triangle Three Buckets (LTTB), which keeps the
+points that contribute most to the visible shape of the line. Since LTTB can
+skip short spikes, the minimum and maximum of every bucket are kept as well.
+
+"""
+import logging
+log = logging.getLogger(__name__)
+log.debug("downsample.py loaded")
+
+import numpy
+
+
+def lttb(x, y, buckets, extremes=True):
+    """Choose points of a series with Largest Triangle Three Buckets.
+
+    Args:
+        x (numpy.ndarray): Sorted float positions of the points.
+        y (numpy.ndarray): Float values of the points, none of them NaN.
+        buckets (int): Number of points to choose, including first and last.
+        extremes (Optional[bool]): Also choose the minimum and maximum of
+            every bucket.
+    Returns:
+        Sorted integer array of indexes of chosen points.
+
+    """
+    count = len(x)
+    if buckets >= count or buckets < 3:
+        return numpy.arange(count)
+    every = float(count - 2) / (buckets - 2)
+    chosen = [0]
+    previous = 0
+    for i in range(buckets - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        following = min(int((i + 2) * every) + 1, count)
+        # The third point of each triangle is the average of the next bucket.
+        average_x = x[end:following].mean()
+        average_y = y[end:following].mean()
+        areas = numpy.abs(
+            (x[previous] - average_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (average_y - y[previous])
+        )
+        previous = start + int(numpy.argmax(areas))
+        chosen.append(previous)
+        if extremes:
+            chosen.append(start + int(numpy.argmin(y[start:end])))
+            chosen.append(start + int(numpy.argmax(y[start:end])))
+    chosen.append(count - 1)
+    return numpy.unique(chosen)
+
+
+def downsample(dates, values, points):
+    """Reduce a series to about `points` points, keeping its shape and the
+    extremes of every bucket.
+
+    Args:
+        dates (numpy.ndarray): Sorted datetime64 dates.
+        values (numpy.ndarray): Float values; NaN values are dropped.
+        points (int): Number of points wanted.
+    Returns:
+        Tuple of date and value arrays, with at most `points` items.
+
+    """
+    keep = ~numpy.isnan(values)
+    dates, values = dates[keep], values[keep]
+    if len(values) <= points:
+        return dates, values
+    # Each bucket contributes up to three points: its LTTB point, minimum
+    # and maximum.
+    indexes = lttb(
+        dates.astype("int64").astype(float),
+        values,
+        max(points // 3, 3),
+    )
+    log.debug(
+        "downsample: Reduced {0} points to {1}."
+        .format(len(values), len(indexes))
+    )
+    return dates[indexes], values[indexes]
@@ -0,0 +1,187 @@
+"""Streaming export of stored device history. States are read from the
+storage engine in batches and written out block by block, so exports of any
+length never sit in memory.
+
+Two formats are supported. `csv` has a header row and `thing_id`, `state`,
+`date` and `value` columns. `bin` is a compact columnar format: the 5 bytes
+`MONX\\x01`, followed by blocks that each hold states of one series:
+
+    uint16 length, thing_id (UTF-8)
+    uint16 length, state (UTF-8)
+    uint32 n
+    n x int64 milliseconds since epoch
+    n x float64 values, NaN where not numeric
+
+All integers and floats are little endian.
+
+An interrupted export is resumed by passing the series and date of the last
+state received as `after`. The resumed stream continues with the next state
+and leaves out the CSV header or `bin` magic, so it can be appended to the
+partial file.
+
+"""
+import logging
+log = logging.getLogger(__name__)
+log.debug("export.py loaded")
+
+import csv
+import struct
+from datetime import datetime
+from cStringIO import StringIO
+import numpy
+import smartthings
+import storage
+
+
+BLOCK_SIZE = 5000 # states written per chunk
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+MAGIC = "MONX\x01"
+FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "bin": "application/octet-stream",
+}
+
+
+def series(token, thing_ids=None, attributes=None):
+    """List series of an account to export.
+
+    Args:
+        token (str): Access token of the account.
+        thing_ids (Optional[list]): Limit to things with these IDs.
+        attributes (Optional[list]): Limit to these attributes.
+    Returns:
+        List of `(thing_id, state)` tuples in a stable order.
+
+    """
+    result = []
+    things = smartthings.db.things.find({"token": token}).sort("id")
+    for thing in things:
+        if thing_ids and thing["id"] not in thing_ids:
+            continue
+        for attribute in sorted(smartthings.attributes(thing)):
+            if attributes and attribute not in attributes:
+                continue
+            result.append((thing["id"], attribute))
+    return result
+
+
+def parse_after(value):
+    """Parse the `after` position of a resumed export.
+
+    Args:
+        value (str): `thing_id,state,date`, with the date formatted as in
+            CSV exports.
+    Returns:
+        Tuple of thing ID, state and datetime.
+    Raises:
+        ValueError: If value is malformed.
+
+    """
+    thing_id, state, date = value.rsplit(",", 2)
+    return thing_id, state, datetime.strptime(date, DATE_FORMAT)
+
+
+def blocks(selected, since=None, until=None, after=None):
+    """Read states of series in blocks, starting after a given state so an
+    interrupted export can be resumed.
+
+    Args:
+        selected (list): `(thing_id, state)` tuples as returned by series().
+        since (Optional[datetime]): Limit to states on or after this time.
+        until (Optional[datetime]): Limit to states before this time.
+        after (Optional[tuple]): Thing ID, state and date of the last state
+            already exported, as returned by parse_after().
+    Returns:
+        Iterator of `(thing_id, state, states)` tuples, with at most
+        BLOCK_SIZE states in each.
+    Raises:
+        ValueError: If the series of `after` is not selected.
+
+    """
+    store = storage.store(smartthings.db)
+    if after is not None:
+        # Series are exported in a stable order; skip those already done.
+        selected = selected[selected.index(after[:2]):]
+    for thing_id, state in selected:
+        start, last = since, None
+        if after is not None and (thing_id, state) == after[:2]:
+            last = after[2]
+            start = max(since, last) if since is not None else last
+        block = []
+        for item in store.find(thing_id, state, start, until):
+            if last is not None and item["date"] <= last:
+                continue
+            block.append(item)
+            if len(block) >= BLOCK_SIZE:
+                yield thing_id, state, block
+                block = []
+        if block:
+            yield thing_id, state, block
+
+
+def csv_chunks(source, header=True):
+    """Encode blocks from blocks() as CSV, one chunk per block, after a
+    header row unless `header` is False."""
+    if header:
+        output = StringIO()
+        writer = csv.writer(output)
+        writer.writerow(["thing_id", "state", "date", "value"])
+        yield output.getvalue()
+    for thing_id, state, block in source:
+        output = StringIO()
+        writer = csv.writer(output)
+        for item in block:
+            writer.writerow([
+                thing_id.encode("utf-8"),
+                state.encode("utf-8"),
+                item["date"].strftime(DATE_FORMAT),
+                unicode(item["value"]).encode("utf-8"),
+            ])
+        yield output.getvalue()
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return numpy.nan
+
+
+def binary_chunks(source, header=True):
+    """Encode blocks from blocks() in the columnar format, one chunk per
+    block, after the magic unless `header` is False."""
+    if header:
+        yield MAGIC
+    epoch = numpy.datetime64("1970-01-01T00:00:00", "ms")
+    for thing_id, state, block in source:
+        thing_id = thing_id.encode("utf-8")
+        state = state.encode("utf-8")
+        dates = numpy.array([x["date"] for x in block], dtype="datetime64[ms]")
+        values = numpy.array([_number(x["value"]) for x in block], dtype="<f8")
+        yield "".join([
+            struct.pack("<H", len(thing_id)), thing_id,
+            struct.pack("<H", len(state)), state,
+            struct.pack("<I", len(block)),
+            (dates - epoch).astype("<i8").tobytes(),
+            values.tobytes(),
+        ])
+
+
+def chunks(kind, selected, since=None, until=None, after=None):
+    """Stream an export.
+
+    Args:
+        kind (str): Format, a key of FORMATS.
+        selected (list): `(thing_id, state)` tuples as returned by series().
+        since (Optional[datetime]): Limit to states on or after this time.
+        until (Optional[datetime]): Limit to states before this time.
+        after (Optional[tuple]): Last state already exported, as returned by
+            parse_after(), to resume an export without its header.
+    Returns:
+        Iterator of byte strings.
+
+    """
+    source = blocks(selected, since, until, after)
+    if kind == "bin":
+        return binary_chunks(source, header=after is None)
+    return csv_chunks(source, header=after is None)
@@ -0,0 +1,229 @@
+"""Declared indexes for the monitor database. Indexes are applied by running
+`tasks.py indexes` (and before every regular `tasks.py` run), which creates
+anything missing and reports drift between the database and the set declared
+here. Nothing is ever dropped automatically.
+
+A unique index cannot be created on a collection already holding duplicates
+of its key. Such indexes are reported as failed and skipped, so tasks that do
+not write states still run, until `tasks.py indexes` removes the duplicates
+and creates them. Ingestion relies on the indexes in REQUIRED to deduplicate
+states and refuses to run while any of them failed.
+
+"""
+import logging
+log = logging.getLogger(__name__)
+log.debug("indexes.py loaded")
+
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+import rollups
+
+
+# collection name -> list of (index name, key specification, options)
+INDEXES = {
+    "accounts": [
+        ("token_1", [("token", ASCENDING)], {}),
+    ],
+    "backfills": [
+        ("token_1_thing_id_1_state_1_start_1", [
+            ("token",    ASCENDING),
+            ("thing_id", ASCENDING),
+            ("state",    ASCENDING),
+            ("start",    ASCENDING),
+        ], {"unique": True}),
+        ("token_1_done_1", [
+            ("token", ASCENDING),
+            ("done",  ASCENDING),
+        ], {}),
+    ],
+    "budgets": [
+        ("token_1", [("token", ASCENDING)], {"unique": True}),
+    ],
+    "calls": [
+        ("token_1_function_1_thing_id_1_state_1", [
+            ("token",    ASCENDING),
+            ("function", ASCENDING),
+            ("thing_id", ASCENDING),
+            ("state",    ASCENDING),
+        ], {}),
+    ],
+    "things": [
+        ("token_1_id_1", [
+            ("token", ASCENDING),
+            ("id",    ASCENDING),
+        ], {"unique": True}),
+        ("token_1_active_1", [
+            ("token",  ASCENDING),
+            ("active", ASCENDING),
+        ], {}),
+    ],
+    "jobs": [
+        ("token_1_thing_id_1_state_1", [
+            ("token",    ASCENDING),
+            ("thing_id", ASCENDING),
+            ("state",    ASCENDING),
+        ], {"unique": True}),
+        ("due_1", [("due", ASCENDING)], {}),
+    ],
+    "refreshes": [
+        ("token_1", [("token", ASCENDING)], {"unique": True}),
+        ("requested_1", [("requested", ASCENDING)], {}),
+    ],
+    "schedule": [
+        ("token_1_thing_id_1_state_1", [
+            ("token",    ASCENDING),
+            ("thing_id", ASCENDING),
+            ("state",    ASCENDING),
+        ], {"unique": True}),
+    ],
+    "series": [
+        ("thing_id_1_state_1", [
+            ("thing_id", ASCENDING),
+            ("state",    ASCENDING),
+        ], {"unique": True}),
+    ],
+    "state_buckets": [
+        # Deduplicates buckets; storage.BucketStore relies on this being unique.
+        ("thing_id_1_state_1_bucket_1", [
+            ("thing_id", ASCENDING),
+            ("state",    ASCENDING),
+            ("bucket",   ASCENDING),
+        ], {"unique": True}),
+    ],
+    "states": [
+        # Deduplicates states; ingestion relies on this being unique.
+        ("thing_id_1_state_1_date_1", [
+            ("thing_id", ASCENDING),
+            ("state",    ASCENDING),
+            ("date",     ASCENDING),
+        ], {"unique": True}),
+    ],
+    "users": [
+        ("shortcode_1", [("shortcode", ASCENDING)], {
+            "unique": True,
+            "sparse": True,
+        }),
+    ],
+}
+# Rollups share the deduplication key of states.
+for resolution, size in rollups.RESOLUTIONS:
+    INDEXES[rollups.collection_name(resolution)] = [
+        ("thing_id_1_state_1_date_1", [
+            ("thing_id", ASCENDING),
+            ("state",    ASCENDING),
+            ("date",     ASCENDING),
+        ], {"unique": True}),
+    ]
+
+# Indexes ingestion relies on to deduplicate states, as `collection.index_name`.
+REQUIRED = (
+    "state_buckets.thing_id_1_state_1_bucket_1",
+    "states.thing_id_1_state_1_date_1",
+)
+
+# Index options that are compared when looking for drift.
+COMPARED_OPTIONS = ("unique", "sparse", "expireAfterSeconds")
+
+
+def _options(info):
+    """Return the compared options from an index_information() entry."""
+    return dict(
+        (k, info[k]) for k in COMPARED_OPTIONS if info.get(k)
+    )
+
+
+def dedupe(collection, keys):
+    """Delete documents duplicating the key of another document, keeping the
+    one with the lowest `_id`.
+
+    Args:
+        collection (pymongo.collection.Collection): Collection to clean.
+        keys (list): Key specification of a unique index.
+    Returns:
+        Number of documents deleted.
+
+    """
+    group = dict((k, "${0}".format(k)) for k, direction in keys)
+    deleted = 0
+    for duplicate in collection.aggregate(
+        [
+            {"$sort": {"_id": ASCENDING}},
+            {"$group": {
+                "_id": group,
+                "ids": {"$push": "$_id"},
+                "n":   {"$sum": 1},
+            }},
+            {"$match": {"n": {"$gt": 1}}},
+        ],
+        allowDiskUse=True,
+    ):
+        result = collection.delete_many({"_id": {"$in": duplicate["ids"][1:]}})
+        deleted += result.deleted_count
+    return deleted
+
+
+def ensure(db, remove_duplicates=False):
+    """Create any missing declared indexes and report drift. Safe to run
+    repeatedly; existing indexes are left untouched.
+
+    Args:
+        db (pymongo.database.Database): Database to apply indexes to.
+        remove_duplicates (Optional[bool]): Delete documents preventing a
+            unique index from being created, instead of skipping the index.
+
+    Returns:
+        Dictionary with lists of `created` indexes, `conflicting` indexes whose
+        keys match a declared index but whose options differ, `extra` indexes
+        that exist but are not declared, and `failed` indexes that could not
+        be created. Entries are strings of the form `collection.index_name`.
+
+    """
+    report = {
+        "created":     [],
+        "conflicting": [],
+        "extra":       [],
+        "failed":      [],
+    }
+    for collection_name in sorted(INDEXES):
+        collection = db[collection_name]
+        existing = collection.index_information()
+        declared_keys = []
+        for name, keys, options in INDEXES[collection_name]:
+            declared_keys.append(keys)
+            match = None
+            for existing_name, info in existing.items():
+                if [tuple(k) for k in info["key"]] == keys:
+                    match = existing_name
+                    break
+            label = "{0}.{1}".format(collection_name, name)
+            if match is None:
+                log.debug("ensure: creating index {0}".format(label))
+                try:
+                    collection.create_index(keys, name=name, **options)
+                except OperationFailure:
+                    if not (remove_duplicates and options.get("unique")):
+                        log.exception(
+                            "ensure: creating index {0} failed".format(label)
+                        )
+                        report["failed"].append(label)
+                        continue
+                    log.debug(
+                        "ensure: deleted {0} duplicates blocking {1}"
+                        .format(dedupe(collection, keys), label)
+                    )
+                    collection.create_index(keys, name=name, **options)
+                report["created"].append(label)
+            elif _options(existing[match]) != options:
+                log.debug(
+                    "ensure: index {0} has options {1}, expected {2}"
+                    .format(label, _options(existing[match]), options)
+                )
+                report["conflicting"].append(label)
+        for existing_name, info in existing.items():
+            if existing_name == "_id_":
+                continue
+            if [tuple(k) for k in info["key"]] not in declared_keys:
+                report["extra"].append(
+                    "{0}.{1}".format(collection_name, existing_name)
+                )
+    return report
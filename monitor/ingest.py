@@ -0,0 +1,127 @@
+"""Ingestion of states pushed by the SmartApp. When push is enabled with
+SmartThings.enable_push(), the SmartApp subscribes to all attributes of the
+selected things and POSTs batches of events to the `/ingest/<shortcode>` route
+of `main.py`, which hands them to submit().
+
+Batches wait on a bounded queue and are written by a single background
+thread, which merges queued batches into larger bulk writes. When the queue is
+full, submit() fails and the route answers HTTP 503, so the web app never
+buffers more than QUEUE_SIZE batches. Pushed states are deduplicated against
+polled ones, so polling is only needed to reconcile anything the SmartApp
+failed to push. Polling resumes from the newest polled state of a series, see
+SmartThings.last_polled(), so pushed states never hide earlier ones that were
+not pushed.
+
+Synthetic batches can be posted to a running app for testing:
+
+    ../bin/python ingest.py http://localhost:8080/ingest/<shortcode> <key> <thing_id> --batches 10 --size 100
+
+"""
+import logging
+log = logging.getLogger(__name__)
+log.debug("ingest.py loaded")
+
+import Queue
+import threading
+import metrics
+import smartthings
+
+
+QUEUE_SIZE  = 1000 # pushed batches waiting to be written
+WRITE_BATCH = smartthings.BATCH_SIZE # events merged into one write
+KEY_HEADER  = "X-Monitor-Key" # header holding the account's push key
+
+_queue = Queue.Queue(QUEUE_SIZE)
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def submit(token, events):
+    """Queue pushed events to be written.
+
+    Args:
+        token (str): Access token of the account that pushed the events.
+        events (list): Events as posted by the SmartApp.
+    Raises:
+        Queue.Full: If the writer has fallen QUEUE_SIZE batches behind.
+
+    """
+    _start()
+    try:
+        _queue.put_nowait((token, events))
+    except Queue.Full:
+        metrics.PUSH_BATCHES.inc(result="rejected")
+        raise
+    metrics.PUSH_BATCHES.inc(result="queued")
+
+
+def flush():
+    """Wait until all queued events have been written."""
+    _queue.join()
+
+
+def _start():
+    """Start the writer thread if not running."""
+    global _writer
+    with _writer_lock:
+        if _writer is None or not _writer.is_alive():
+            _writer = threading.Thread(target=_write_forever, name="ingest")
+            _writer.daemon = True
+            _writer.start()
+
+
+def _write_forever():
+    """Write queued batches, merging those waiting into larger writes."""
+    while True:
+        token, events = _queue.get()
+        pending = {token: list(events)}
+        taken = 1
+        count = len(events)
+        while count < WRITE_BATCH:
+            try:
+                token, events = _queue.get_nowait()
+            except Queue.Empty:
+                break
+            pending.setdefault(token, []).extend(events)
+            taken += 1
+            count += len(events)
+        for token, events in pending.items():
+            try:
+                smartthings.client(token).save_pushed(events)
+            except Exception:
+                log.exception("_write_forever: writing pushed states failed")
+        for i in range(taken):
+            _queue.task_done()
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    import random
+    import requests
+    from datetime import datetime, timedelta
+    parser = argparse.ArgumentParser(description="Post synthetic state batches.")
+    parser.add_argument("url", help="address of /ingest/<shortcode>")
+    parser.add_argument("key", help="push key of the account")
+    parser.add_argument("thing_id", help="ID of a thing of the account")
+    parser.add_argument("--state", default="temperature")
+    parser.add_argument("--batches", type=int, default=10)
+    parser.add_argument("--size", type=int, default=100)
+    args = parser.parse_args()
+    date = datetime.utcnow().replace(microsecond=0)
+    for i in range(args.batches):
+        events = []
+        for j in range(args.size):
+            date -= timedelta(seconds=1)
+            events.append({
+                "thing_id": args.thing_id,
+                "state":    args.state,
+                "date":     date.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                "value":    str(round(random.uniform(60, 80), 1)),
+            })
+        response = requests.post(
+            args.url,
+            data=json.dumps({"events": events}),
+            headers={KEY_HEADER: args.key, "Content-Type": "application/json"},
+        )
+        print "Batch {0}: HTTP {1}".format(i, response.status_code)
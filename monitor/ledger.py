@@ -0,0 +1,156 @@
+"""In-memory ledger of API call times, kept in front of the `calls`
+collection. Freshness checks are answered from memory when a call was made
+recently enough, and only otherwise confirmed against the collection, since
+another process may have made the call. New call times are written behind in
+batches, using `$max` so a slower process never moves a time backwards.
+
+A new call time reaches the collection within FLUSH_INTERVAL seconds, even if
+the process makes no further calls, so other processes see it shortly after.
+Until then another process may repeat the call, which is harmless since
+storage skips states already stored.
+
+"""
+import logging
+log = logging.getLogger(__name__)
+log.debug("ledger.py loaded")
+
+import atexit
+import threading
+import time
+from pymongo import UpdateOne
+
+
+FLUSH_INTERVAL = 5   # seconds a new call time waits before it is written
+FLUSH_SIZE     = 100 # new call times that trigger an immediate write
+
+
+def _key(params):
+    """Return hashable key for call params."""
+    return tuple(sorted(params.items()))
+
+
+class Ledger(object):
+    """Call times for query params, backed by a collection whose documents
+    are the params plus a `date`.
+    """
+
+    def __init__(self, collection):
+        """Set up empty ledger. It is filled from the collection on first use.
+
+        Args:
+            collection (pymongo.collection.Collection): Collection of calls.
+        """
+        self._collection = collection
+        self._times = {}
+        self._dirty = {}
+        self._lock = threading.Lock()
+        self._warm = False
+        self._flushed = time.time()
+        self._timer = None
+
+    def warm(self):
+        """Load all call times from the collection."""
+        times = {}
+        for document in self._collection.find():
+            date = document.pop("date", None)
+            document.pop("_id", None)
+            if date is not None:
+                times[_key(document)] = date
+        with self._lock:
+            for key, date in times.items():
+                if key not in self._times or self._times[key] < date:
+                    self._times[key] = date
+            self._warm = True
+        log.debug("warm: Loaded {0} call times.".format(len(times)))
+
+    def get(self, params, cutoff=None):
+        """Get time of last call with params.
+
+        Args:
+            params (dict): Data characterizing a call.
+            cutoff (Optional[datetime]): Times after this are trusted from
+                memory; older or missing times are confirmed with the
+                collection in case another process made the call since.
+        Returns:
+            datetime of last call or None if no call is known.
+
+        """
+        if not self._warm:
+            self.warm()
+        key = _key(params)
+        with self._lock:
+            date = self._times.get(key)
+        if date is not None and cutoff is not None and date > cutoff:
+            return date
+        document = self._collection.find_one(params, {"date": True})
+        if document and "date" in document:
+            with self._lock:
+                if key not in self._times or self._times[key] < document["date"]:
+                    self._times[key] = document["date"]
+                date = self._times[key]
+        return date
+
+    def set(self, params, date):
+        """Record time of a call with params, writing it to the collection
+        later.
+
+        Args:
+            params (dict): Data characterizing a call.
+            date (datetime): Time of the call.
+        """
+        key = _key(params)
+        with self._lock:
+            self._times[key] = date
+            self._dirty[key] = date
+            due = (
+                len(self._dirty) >= FLUSH_SIZE or
+                time.time() - self._flushed >= FLUSH_INTERVAL
+            )
+            if not due and self._timer is None:
+                # Write this time even if no other call follows.
+                self._timer = threading.Timer(FLUSH_INTERVAL, self._flush_later)
+                self._timer.daemon = True
+                self._timer.start()
+        if due:
+            self.flush()
+
+    def _flush_later(self):
+        """Flush from the timer thread."""
+        with self._lock:
+            self._timer = None
+        try:
+            self.flush()
+        except Exception:
+            log.exception("_flush_later: could not write call times")
+
+    def flush(self):
+        """Write all new call times to the collection."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            self._flushed = time.time()
+        if not dirty:
+            return
+        self._collection.bulk_write([
+            UpdateOne(dict(key), {"$max": {"date": date}}, upsert=True)
+            for key, date in dirty.items()
+        ], ordered=False)
+        log.debug("flush: Wrote {0} call times.".format(len(dirty)))
+
+
+_ledgers = []
+
+
+def ledger(collection):
+    """Create a Ledger that is flushed when the process exits."""
+    result = Ledger(collection)
+    _ledgers.append(result)
+    return result
+
+
+@atexit.register
+def _flush_all():
+    for item in _ledgers:
+        try:
+            item.flush()
+        except Exception:
+            log.exception("_flush_all: could not write call times")
@@ -15,7 +15,14 @@ import web
 from webpy_mongodb_sessions.session import MongoStore
 import webpy_mongodb_sessions.users as users
 # API interaction, database and data handling
-import smartthings, processor
+import smartthings, processor, cache, metrics, export, ingest, sessions
+import hashlib
+import hmac
+import json
+import Queue
+import re
+import time
+from datetime import datetime
 
 
 """
@@ -35,10 +42,17 @@ routes = (
     '/login',     'login',
     '/logout',    'logout',
     '/register',  'register',
+    '/data/(.+)/window', 'window',
     '/data/(.+)', 'data',
+    '/metrics',   'scrape',
+    '/export/(.+)', 'download',
+    '/ingest/(.+)', 'receive',
 )
 app     = web.application( routes, globals() )
-session = web.session.Session(app, MongoStore(smartthings.db))
+session = web.session.Session(
+    app,
+    sessions.CachedStore(MongoStore(smartthings.db)),
+)
 users.session = session
 users.collection = smartthings.db.users
 
@@ -51,11 +65,24 @@ HELPER FUNCTIONS
 
 
 SHORT_KEY = 'shortcode' # db key to store shortcode
+READ_ONLY = False # serve data from db only; refresh via `tasks.py worker`
+TIMING_HEADER = False # send per request timing breakdown as Server-Timing
+PUSH = False # have SmartApps of newly connected accounts push their states
+MIN_WIDTH = 50 # fewest points per series served for a slider window
+MAX_WIDTH = 4000 # most points per series served for a slider window
 
 
 def current_user():
-    """Return logged in user"""
-    user = users.get_user()
+    """Return logged in user, looked up at most once per cache.USER_TTL
+    seconds per session.
+    """
+    key = (session.session_id,)
+    cached = cache.users.get(key)
+    if cached is not None:
+        user = cached["user"]
+    else:
+        user = users.get_user()
+        cache.users.set(key, {"user": user})
     if user:
         log.debug('user is {0}'.format(user))
         return user
@@ -64,6 +91,81 @@ def current_user():
         return None
 
 
+def forget_user():
+    """Drop the cached user of the current session, such as after logging
+    in or changing the user.
+    """
+    cache.users.invalidate(session.session_id)
+
+
+def parse_date(value):
+    """Parse a `YYYY-MM-DD` date from request parameters.
+
+    Args:
+        value (Optional[str]): Date string, or None if not given.
+
+    Returns:
+        datetime.datetime or None if value is empty.
+
+    Raises:
+        ValueError: If value is not a valid date.
+
+    """
+    if not value:
+        return None
+    return datetime.strptime(value, '%Y-%m-%d')
+
+
+def parse_time(value):
+    """Parse a JavaScript time in milliseconds from request parameters. Like
+    the slider dates sent by processor.results(), times are local to the
+    server.
+
+    Args:
+        value (Optional[str]): Milliseconds since epoch, or None if not given.
+
+    Returns:
+        datetime.datetime or None if value is empty.
+
+    Raises:
+        ValueError: If value is not a number.
+
+    """
+    if not value:
+        return None
+    return datetime.fromtimestamp(int(value) / 1000.0)
+
+
+def cached_page(key, compute):
+    """Return a computed page from cache.pages, computing it if missing,
+    expired or older than the account's data, and respond with 304 Not Modified if the
+    browser's copy is current.
+
+    Args:
+        key (tuple): Cache key starting with the account token.
+        compute (callable): Function without arguments computing the page.
+
+    Returns:
+        The computed page.
+
+    """
+    token = key[0]
+    modified = smartthings.modified(token)
+    page = cache.pages.get(key)
+    if page is None or page["modified"] != modified:
+        log.debug('cached_page: computing {0}'.format(key))
+        # Keep the modification time read before computing, so data
+        # written meanwhile causes a recompute on the next request.
+        page = {
+            "values":   compute(),
+            "modified": modified,
+            "etag":     hashlib.sha1(repr((key, modified))).hexdigest(),
+        }
+        cache.pages.set(key, page)
+    web.modified(date=page["modified"], etag=page["etag"])
+    return page["values"]
+
+
 def new_shortcode(collection, keyname='shortcode', length=5):
     """Generate alphanumeric case sensitive codes until one is found that is not
     already associated with a document in a collection.
@@ -126,8 +228,55 @@ def internalerror():
     return web.internalerror(render.error(500))
 
 
+def route_name(path):
+    """Return name of the handler class routed to for a path, or `notfound`
+    if no route matches, so metrics are labelled by a bounded set of names.
+    """
+    for pattern, name in zip(routes[::2], routes[1::2]):
+        if re.match('^' + pattern + '$', path):
+            return name
+    return 'notfound'
+
+
+def instrument(handler):
+    """Record latency and status of each request in metrics, and optionally
+    send a timing breakdown in a Server-Timing header.
+
+    Requires `app.add_processor(instrument)` following definition.
+    """
+
+    name = route_name(web.ctx.path)
+    started = time.time()
+    status = None
+    metrics.begin()
+    try:
+        result = handler()
+        if TIMING_HEADER:
+            breakdown = metrics.end()
+            breakdown['total'] = time.time() - started
+            web.header('Server-Timing', ', '.join(
+                '{0};dur={1:.1f}'.format(phase, seconds * 1000)
+                for phase, seconds in sorted(breakdown.items())
+            ))
+        return result
+    except web.HTTPError:
+        raise # redirects and the like set their own status
+    except Exception:
+        # Turned into a 500 by internalerror() after this processor returns.
+        status = "500"
+        raise
+    finally:
+        metrics.end()
+        metrics.HTTP_SECONDS.observe(time.time() - started, handler=name)
+        metrics.HTTP_RESPONSES.inc(
+            handler=name,
+            status=status or web.ctx.status.split(' ')[0],
+        )
+
+
 app.notfound      = notfound
 app.internalerror = internalerror
+app.add_processor(instrument)
 
 
 class register:
@@ -147,6 +296,7 @@ class register:
             password=users.pswd(password, username),
             )
         users.login(user)
+        forget_user()
         log.debug('user is {0}'.format(user))
         raise web.seeother('/')
 
@@ -182,6 +332,7 @@ class login:
         if user:
             log.debug('user is {0}'.format(user))
             users.login(user)
+            forget_user()
             raise web.seeother('/')
         else:
             log.error('login failed, so user not set')
@@ -193,6 +344,7 @@ class logout:
 
     def GET(self):
         log.debug('logout.GET')
+        forget_user()
         users.logout() #  runs session.kill()
         raise web.seeother('/')
 
@@ -227,6 +379,17 @@ class connect:
                     keyname=SHORT_KEY,
                     )
                 users.register(**user) #  not totally sure why need **
+                forget_user()
+                if PUSH:
+                    try:
+                        smartthings.client(user['token']).enable_push(
+                            template_globals['app_path'](
+                                '/ingest/{0}'.format(user[SHORT_KEY])
+                            )
+                        )
+                    except Exception:
+                        # Polling still works; push can be enabled later.
+                        log.exception('connect.GET: enabling push failed')
                 result_url = '/data/{0}'.format(user[SHORT_KEY])
                 raise web.seeother(result_url)
             else:
@@ -261,7 +424,19 @@ class data:
         else:
             log.debug('no user found matching shortcode')
             raise web.seeother('/error')
-        return render.data(processor.results(user["token"]))
+        params = web.input(since=None, until=None)
+        try:
+            since = parse_date(params.since)
+            until = parse_date(params.until)
+        except ValueError:
+            log.debug('invalid date window {0}'.format(params))
+            raise web.seeother('/error')
+        token = user["token"]
+        values = cached_page(
+            (token, since, until),
+            lambda: processor.results(token, since, until, READ_ONLY),
+        )
+        return render.data(values)
 
     def POST(self):
         log.debug('data.POST')
@@ -284,6 +459,134 @@ class data:
             raise web.seeother('/error')
 
 
+class window:
+    """Handle chart data for one window of a user's date slider.
+
+    Query parameters:
+        since, until: Window in JavaScript milliseconds.
+        width: Chart width in pixels, the number of points wanted per series.
+    """
+
+    def GET(self, shortcode):
+        log.debug('window.GET')
+        user = users.collection.find_one({SHORT_KEY: shortcode})
+        if not user:
+            log.debug('no user found matching shortcode')
+            raise web.notfound()
+        params = web.input(since=None, until=None, width=None)
+        try:
+            since = parse_time(params.since)
+            until = parse_time(params.until)
+            width = int(params.width or processor.CHART_WIDTH)
+        except ValueError:
+            log.debug('invalid window {0}'.format(params))
+            raise web.badrequest()
+        if since is None or until is None or since >= until:
+            raise web.badrequest()
+        width = min(max(width, MIN_WIDTH), MAX_WIDTH)
+        token = user["token"]
+        web.header('Content-Type', 'application/json')
+        return cached_page(
+            (token, "window", since, until, width),
+            lambda: processor.window(token, since, until, width, READ_ONLY),
+        )
+
+
+class download:
+    """Handle streaming export of a user's device history.
+
+    Query parameters, all optional:
+        things: Comma separated thing IDs. Defaults to all things.
+        attributes: Comma separated attributes. Defaults to all attributes.
+        since, until: `YYYY-MM-DD` dates limiting the exported range.
+        after: `thing_id,state,date` of the last state received, to resume
+            an interrupted export; see export.py.
+        format: `csv` (default) or `bin`; see export.py.
+    """
+
+    def GET(self, shortcode):
+        log.debug('download.GET')
+        user = users.collection.find_one({SHORT_KEY: shortcode})
+        if not user or 'token' not in user:
+            log.debug('no connected user found matching shortcode')
+            raise web.seeother('/error')
+        params = web.input(
+            things='',
+            attributes='',
+            since=None,
+            until=None,
+            after=None,
+            format='csv',
+        )
+        try:
+            since = parse_date(params.since)
+            until = parse_date(params.until)
+            after = export.parse_after(params.after) if params.after else None
+        except ValueError:
+            log.debug('invalid export parameters {0}'.format(params))
+            raise web.seeother('/error')
+        if params.format not in export.FORMATS:
+            raise web.seeother('/error')
+        selected = export.series(
+            user['token'],
+            [x for x in params.things.split(',') if x],
+            [x for x in params.attributes.split(',') if x],
+        )
+        if after is not None and after[:2] not in selected:
+            log.debug('resumed series {0} is not exported'.format(after[:2]))
+            raise web.seeother('/error')
+        web.header('Content-Type', export.FORMATS[params.format])
+        web.header(
+            'Content-Disposition',
+            'attachment; filename="{0}.{1}"'.format(shortcode, params.format),
+        )
+        web.header('Transfer-Encoding', 'chunked')
+        return export.chunks(params.format, selected, since, until, after)
+
+
+class receive:
+    """Handle states pushed by a user's SmartApp. The body is a JSON object
+    with an `events` list, and the account's push key must be sent in the
+    ingest.KEY_HEADER header.
+    """
+
+    def POST(self, shortcode):
+        log.debug('receive.POST')
+        user = users.collection.find_one({SHORT_KEY: shortcode})
+        if not user or 'token' not in user:
+            raise web.notfound()
+        key = web.ctx.env.get(
+            'HTTP_' + ingest.KEY_HEADER.upper().replace('-', '_'),
+            '',
+        )
+        if not hmac.compare_digest(
+                str(key),
+                str(smartthings.push_key(user['token']))):
+            raise web.unauthorized()
+        try:
+            events = json.loads(web.data())['events']
+        except (ValueError, KeyError, TypeError):
+            raise web.badrequest()
+        if not isinstance(events, list):
+            raise web.badrequest()
+        try:
+            ingest.submit(user['token'], events)
+        except Queue.Full:
+            log.error('receive.POST: ingest queue full')
+            web.header('Retry-After', '60')
+            raise web.HTTPError('503 Service Unavailable')
+        web.ctx.status = '202 Accepted'
+        return ''
+
+
+class scrape:
+    """Handle metrics scraping in Prometheus text format."""
+
+    def GET(self):
+        web.header('Content-Type', 'text/plain; version=0.0.4')
+        return metrics.exposition()
+
+
 if __name__ == "__main__":
     app.run()
 
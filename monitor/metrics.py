@@ -0,0 +1,227 @@
+"""Counters and histograms for hot paths, exposed in Prometheus text format by
+the `/metrics` route of `main.py`. Observations take a lock and update a few
+numbers, so instrumentation is cheap enough to leave on.
+
+Histograms created with a `phase` also add their observations to a per
+request breakdown, which `main.py` can send in a `Server-Timing` header.
+
+"""
+import logging
+log = logging.getLogger(__name__)
+log.debug("metrics.py loaded")
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Upper bounds in seconds of histogram buckets.
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_metrics = []
+_local = threading.local()
+
+
+def _labels(labels):
+    """Return hashable key for label values."""
+    return tuple(sorted(labels.items()))
+
+
+def _format(name, key, extra=()):
+    """Return sample name with labels in Prometheus text format."""
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return name
+    return "{0}{{{1}}}".format(name, ",".join(
+        '{0}="{1}"'.format(k, str(v).replace('"', '\\"')) for k, v in pairs
+    ))
+
+
+class Counter(object):
+    """Monotonically increasing count per set of label values."""
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        """Add amount to the count for given label values."""
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def exposition(self):
+        """Return lines in Prometheus text format."""
+        lines = [
+            "# HELP {0} {1}".format(self.name, self.description),
+            "# TYPE {0} counter".format(self.name),
+        ]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append("{0} {1}".format(_format(self.name, key), value))
+        return lines
+
+
+class Histogram(object):
+    """Distribution of observed values per set of label values."""
+
+    def __init__(self, name, description, buckets=BUCKETS, phase=None):
+        self.name = name
+        self.description = description
+        self.phase = phase
+        self._buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        """Record a value for given label values."""
+        key = _labels(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self._buckets), 0, 0.0]
+            counts, total, _ = entry = self._values[key]
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            entry[1] += 1
+            entry[2] += value
+        if self.phase is not None:
+            breakdown = getattr(_local, "breakdown", None)
+            if breakdown is not None:
+                breakdown[self.phase] = breakdown.get(self.phase, 0) + value
+
+    def exposition(self):
+        """Return lines in Prometheus text format."""
+        lines = [
+            "# HELP {0} {1}".format(self.name, self.description),
+            "# TYPE {0} histogram".format(self.name),
+        ]
+        with self._lock:
+            for key, (counts, total, value_sum) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self._buckets, counts):
+                    cumulative += count
+                    lines.append("{0} {1}".format(
+                        _format(self.name + "_bucket", key, [("le", bound)]),
+                        cumulative,
+                    ))
+                lines.append("{0} {1}".format(
+                    _format(self.name + "_bucket", key, [("le", "+Inf")]),
+                    total,
+                ))
+                lines.append("{0} {1}".format(_format(self.name + "_sum", key), value_sum))
+                lines.append("{0} {1}".format(_format(self.name + "_count", key), total))
+        return lines
+
+
+@contextmanager
+def timer(histogram, **labels):
+    """Observe the seconds spent in a with block."""
+    started = time.time()
+    try:
+        yield
+    finally:
+        histogram.observe(time.time() - started, **labels)
+
+
+def begin():
+    """Start collecting a timing breakdown for the current thread."""
+    _local.breakdown = {}
+
+
+def end():
+    """Stop collecting the timing breakdown of the current thread.
+
+    Returns:
+        Dictionary of seconds spent per phase.
+
+    """
+    breakdown = getattr(_local, "breakdown", None) or {}
+    _local.breakdown = None
+    return breakdown
+
+
+def add(breakdown):
+    """Add a breakdown collected on another thread, such as a pool thread
+    doing part of the request's work, to the current thread's breakdown.
+
+    Args:
+        breakdown (dict): Seconds spent per phase, as returned by end().
+    """
+    current = getattr(_local, "breakdown", None)
+    if current is None:
+        return
+    for phase, seconds in breakdown.items():
+        current[phase] = current.get(phase, 0) + seconds
+
+
+def exposition():
+    """Return all metrics in Prometheus text format."""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.exposition())
+    return "\n".join(lines) + "\n"
+
+
+API_SECONDS = Histogram(
+    "monitor_api_request_seconds",
+    "Latency of SmartApp API requests.",
+    phase="api",
+)
+API_RESPONSES = Counter(
+    "monitor_api_responses_total",
+    "SmartApp API responses by function and HTTP status.",
+)
+API_WAIT_SECONDS = Histogram(
+    "monitor_api_rate_limit_wait_seconds",
+    "Time spent waiting for the account rate limit budget or after HTTP 429.",
+    phase="wait",
+)
+INGEST_ROWS = Counter(
+    "monitor_ingest_rows_total",
+    "Things and states received from the API, by collection.",
+)
+INGEST_WRITES = Counter(
+    "monitor_ingest_writes_total",
+    "Things and states new to the database, by collection.",
+)
+ARCHIVE_DROPPED = Counter(
+    "monitor_archive_dropped_total",
+    "States older than the archived range of their series, not stored.",
+)
+PUSH_BATCHES = Counter(
+    "monitor_push_batches_total",
+    "Batches of states pushed by the SmartApp, by whether they were queued.",
+)
+DB_SECONDS = Histogram(
+    "monitor_db_write_seconds",
+    "Time spent writing ingested data, by collection.",
+    phase="db",
+)
+RESULTS_QUERY_SECONDS = Histogram(
+    "monitor_results_query_seconds",
+    "Time spent reading chart data in processor.chart().",
+    phase="query",
+)
+RESULTS_ROWS = Counter(
+    "monitor_results_rows_total",
+    "Rows read for charts in processor.chart().",
+)
+RESULTS_SERIALIZE_SECONDS = Histogram(
+    "monitor_results_serialize_seconds",
+    "Time spent building chart data in processor.",
+    phase="serialize",
+)
+HTTP_SECONDS = Histogram(
+    "monitor_http_request_seconds",
+    "Latency of web requests, by handler.",
+)
+HTTP_RESPONSES = Counter(
+    "monitor_http_responses_total",
+    "Web responses by handler and HTTP status.",
+)
@@ -0,0 +1,281 @@
+"""Concurrent polling engine used by `tasks.py`. Accounts are polled in
+parallel on one thread pool, and each account fans out across its things and
+attributes on its own smaller pool. Every account has a RateBudget driven by
+the `x-ratelimit-*` headers returned by the API, so an account that is being
+rate limited only blocks its own threads.
+
+A RateBudget only covers one process. When several processes poll the same
+accounts, such as the nodes of `workqueue.py`, SharedBudget keeps each
+account's bucket in the database instead, so together they stay within the
+account's limit.
+
+"""
+import logging
+log = logging.getLogger(__name__)
+log.debug("poller.py loaded")
+
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+
+ACCOUNT_WORKERS = 4 # accounts polled at once
+SERIES_WORKERS  = 2 # (thing, attribute) series polled at once per account
+SHARED_POLL     = 1 # most seconds between checks of a shared bucket
+
+
+class RateBudget(object):
+    """Token bucket limiting API requests for one account.
+
+    The bucket starts with `capacity` tokens and refills at `rate` tokens per
+    second. Whenever the API reports its own view of the limit through
+    update(), the bucket is resynchronized to it.
+    """
+
+    def __init__(self, capacity=10, rate=1.0):
+        """Set up a full bucket.
+
+        Args:
+            capacity (Optional[int]): Maximum number of stored tokens.
+            rate (Optional[float]): Tokens added per second.
+        """
+        self._condition = threading.Condition()
+        self._capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._rate = float(rate)
+        self._updated = time.time()
+        self._blocked_until = 0
+
+    def _refill(self, now):
+        """Add tokens accumulated since last refill. Caller holds lock."""
+        elapsed = now - self._updated
+        self._tokens = min(self._capacity, self._tokens + elapsed * self._rate)
+        self._updated = now
+
+    def acquire(self):
+        """Take one token, waiting until one is available."""
+        with self._condition:
+            while True:
+                now = time.time()
+                self._refill(now)
+                if now < self._blocked_until:
+                    wait = self._blocked_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self._rate
+                self._condition.wait(wait)
+
+    def update(self, limit, current, ttl):
+        """Resynchronize bucket with rate limit headers from a response.
+
+        Args:
+            limit (Optional[str]): Requests allowed per window.
+            current (Optional[str]): Requests used in the current window.
+            ttl (Optional[str]): Seconds until the current window resets.
+        """
+        try:
+            limit, current, ttl = int(limit), int(current), float(ttl)
+        except (TypeError, ValueError):
+            return # headers missing or malformed; keep current estimate
+        with self._condition:
+            self._refill(time.time())
+            self._capacity = float(max(limit, 1))
+            self._tokens = float(max(limit - current, 0))
+            # Used requests come back once the window resets.
+            self._rate = max(current, 1) / max(ttl, 1.0)
+            self._condition.notify_all()
+
+    def block(self, seconds):
+        """Stop handing out tokens for a number of seconds, such as after
+        receiving HTTP 429.
+
+        Args:
+            seconds (float): Time to wait before the next request.
+        """
+        with self._condition:
+            self._tokens = 0
+            self._blocked_until = max(self._blocked_until, time.time() + seconds)
+            self._condition.notify_all()
+
+
+class SharedBudget(object):
+    """RateBudget of one account kept in a collection, so that all
+    processes polling the account draw from the same bucket. Each document
+    holds `tokens` as of `updated`, `capacity`, `rate`, `blocked_until` and a
+    `version` incremented by every change, so concurrent takes never spend
+    the same token twice.
+    """
+
+    def __init__(self, collection, token, capacity=10, rate=1.0):
+        """Set up the budget, creating a full bucket if none is stored.
+
+        Args:
+            collection (pymongo.collection.Collection): Collection of buckets.
+            token (str): Access token identifying the account.
+            capacity (Optional[int]): Maximum number of stored tokens.
+            rate (Optional[float]): Tokens added per second.
+        """
+        self._collection = collection
+        self._token = token
+        self._default = {
+            "tokens":        float(capacity),
+            "capacity":      float(capacity),
+            "rate":          float(rate),
+            "updated":       time.time(),
+            "blocked_until": 0,
+            "version":       0,
+        }
+
+    def _load(self):
+        """Return the stored bucket, creating it if missing."""
+        try:
+            return self._collection.find_one_and_update(
+                {"token": self._token},
+                {"$setOnInsert": self._default},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # Created concurrently by another process.
+            return self._collection.find_one({"token": self._token})
+
+    def acquire(self):
+        """Take one token, waiting until one is available."""
+        while True:
+            bucket = self._load()
+            now = time.time()
+            tokens = min(
+                bucket["capacity"],
+                bucket["tokens"] + (now - bucket["updated"]) * bucket["rate"],
+            )
+            if now < bucket["blocked_until"]:
+                wait = bucket["blocked_until"] - now
+            elif tokens >= 1:
+                result = self._collection.update_one(
+                    {"token": self._token, "version": bucket["version"]},
+                    {
+                        "$set": {"tokens": tokens - 1, "updated": now},
+                        "$inc": {"version": 1},
+                    },
+                )
+                if result.matched_count:
+                    return
+                continue # taken or changed by another process; retry
+            else:
+                wait = (1 - tokens) / bucket["rate"]
+            # Check again soon, since other processes may update the bucket.
+            time.sleep(min(wait, SHARED_POLL))
+
+    def update(self, limit, current, ttl):
+        """Resynchronize bucket with rate limit headers from a response.
+
+        Args:
+            limit (Optional[str]): Requests allowed per window.
+            current (Optional[str]): Requests used in the current window.
+            ttl (Optional[str]): Seconds until the current window resets.
+        """
+        try:
+            limit, current, ttl = int(limit), int(current), float(ttl)
+        except (TypeError, ValueError):
+            return # headers missing or malformed; keep current estimate
+        self._load()
+        self._collection.update_one(
+            {"token": self._token},
+            {
+                "$set": {
+                    "capacity": float(max(limit, 1)),
+                    "tokens":   float(max(limit - current, 0)),
+                    "rate":     max(current, 1) / max(ttl, 1.0),
+                    "updated":  time.time(),
+                },
+                "$inc": {"version": 1},
+            },
+        )
+
+    def block(self, seconds):
+        """Stop handing out tokens to all processes for a number of seconds,
+        such as after receiving HTTP 429.
+
+        Args:
+            seconds (float): Time to wait before the next request.
+        """
+        self._load()
+        now = time.time()
+        self._collection.update_one(
+            {"token": self._token},
+            {
+                "$set": {"tokens": 0.0, "updated": now},
+                "$max": {"blocked_until": now + seconds},
+                "$inc": {"version": 1},
+            },
+        )
+
+
+_budgets = {}
+_budgets_lock = threading.Lock()
+_shared = {}
+
+
+def budget(token):
+    """Get the RateBudget for an account, creating it on first use.
+
+    Args:
+        token (str): Access token identifying the account.
+    Returns:
+        RateBudget shared by all pollers of the account in this process.
+
+    """
+    with _budgets_lock:
+        if token not in _budgets:
+            _budgets[token] = RateBudget()
+        return _budgets[token]
+
+
+def shared_budget(collection, token):
+    """Get the SharedBudget for an account stored in a collection.
+
+    Args:
+        collection (pymongo.collection.Collection): Collection of buckets.
+        token (str): Access token identifying the account.
+    Returns:
+        SharedBudget drawing from the bucket all processes share.
+
+    """
+    with _budgets_lock:
+        if token not in _shared:
+            _shared[token] = SharedBudget(collection, token)
+        return _shared[token]
+
+
+def run(function, jobs, workers):
+    """Call function once per job using a pool of threads. A failing job is
+    logged and does not stop the others.
+
+    Args:
+        function (callable): Called with each job as its only argument.
+        jobs (list): Arguments to pass to function.
+        workers (int): Maximum number of jobs running at once.
+    Returns:
+        List of results in the order of jobs, with None for failed jobs.
+
+    """
+
+    def _call(job):
+        try:
+            return function(job)
+        except Exception:
+            log.exception("run: job {0} failed".format(job))
+            return None
+
+    if workers <= 1 or len(jobs) <= 1:
+        return [_call(job) for job in jobs]
+    pool = ThreadPool(min(workers, len(jobs)))
+    try:
+        return pool.map(_call, jobs)
+    finally:
+        pool.close()
+        pool.join()
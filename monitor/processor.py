@@ -2,12 +2,17 @@ import logging
 logger = logging.getLogger(__name__)
 logger.debug("processor.py loaded")
 
-import gviz_api
 import json
+import threading
+import numpy
 from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
 from time import mktime
 
-from smartthings import SmartThings
+import downsample
+import metrics
+import rollups
+from smartthings import client
 
 def update_range(old, new):
     if "max" in new:
@@ -27,11 +32,269 @@ def things(st):
     return 1
 
 
+MAX_VALUE = rollups.ERROR_VALUES["temperature"] # drop readings at or above
+MAX_THINGS = 9 # temperature sensors charted per account
+CHART_WIDTH = 800 # default points per series, about the chart's pixel width
+CHART_WORKERS = 4 # series read at once for all charts of the process
 
-def results(token):
+_pool = None
+_pool_lock = threading.Lock()
 
+
+def pool():
+    """Get the thread pool reading charted series, creating it on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(CHART_WORKERS)
+        return _pool
+
+
+def columns(rows):
+    """Convert rows of a series to arrays.
+
+    Args:
+        rows (iterable): Dictionaries with `date` and `value` keys, such as
+            returned by SmartThings.series().
+    Returns:
+        Tuple of a datetime64[s] array of dates and a float array of values,
+        with NaN for missing or non-numeric values.
+
+    """
+    dates, values = [], []
+    for row in rows:
+        if row["date"] is not None:
+            dates.append(row["date"])
+            values.append(row["value"])
+    try:
+        values = numpy.array(values, dtype=float)
+    except ValueError:
+        # Some values are not numbers; convert one at a time.
+        def _number(value):
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                return numpy.nan
+        values = numpy.array([_number(x) for x in values], dtype=float)
+    return numpy.array(dates, dtype="datetime64[s]"), values
+
+
+def align(series):
+    """Place several series on a shared, sorted time axis.
+
+    Args:
+        series (list): Tuples of date and value arrays as returned by columns().
+    Returns:
+        Tuple of the shared date array and a list of value arrays of the same
+        length, with NaN where a series has no value at a date.
+
+    """
+    if not series:
+        return numpy.array([], dtype="datetime64[s]"), []
+    axis = numpy.unique(numpy.concatenate([dates for dates, values in series]))
+    aligned = []
+    for dates, values in series:
+        column = numpy.full(len(axis), numpy.nan)
+        column[numpy.searchsorted(axis, dates)] = values
+        aligned.append(column)
+    return axis, aligned
+
+
+def datatable(labels, axis, values):
+    """Build JSON for a google.visualization.DataTable, with a `Date` column
+    followed by one number column per label.
+
+    Args:
+        labels (list): Column labels.
+        axis (numpy.ndarray): datetime64[s] dates of the rows.
+        values (list): Integer-valued float arrays, NaN for empty cells.
+    Returns:
+        JSON string.
+
+    """
+    cols = [{"id": "Date", "label": "Date", "type": "datetime"}] + [
+        {"id": label, "label": label, "type": "number"} for label in labels
+    ]
+    # Break dates into components; months are zero based in JavaScript.
+    days = axis.astype("datetime64[D]")
+    months = axis.astype("datetime64[M]")
+    seconds = (axis - days.astype("datetime64[s]")).astype(int)
+    components = zip(
+        (months.astype(int) // 12 + 1970).tolist(),
+        (months.astype(int) % 12).tolist(),
+        ((days - months.astype("datetime64[D]")).astype(int) + 1).tolist(),
+        (seconds // 3600).tolist(),
+        (seconds // 60 % 60).tolist(),
+        (seconds % 60).tolist(),
+    )
+    rows = numpy.array(
+        ['{"c":[{"v":"Date(%d,%d,%d,%d,%d,%d)"}' % x for x in components],
+        dtype=object,
+    )
+    for column in values:
+        empty = numpy.isnan(column)
+        cells = numpy.char.mod(
+            ',{"v":%d}',
+            numpy.where(empty, 0, column).astype(int),
+        ).astype(object)
+        cells[empty] = ",null"
+        rows = rows + cells
+    return "{{\"cols\":{0},\"rows\":[{1}]}}".format(
+        json.dumps(cols),
+        ",".join((rows + "]}").tolist()),
+    )
+
+
+def jscode(name, labels, axis, values):
+    """Build JavaScript creating a google.visualization.DataTable from the
+    JSON of datatable().
+
+    Args:
+        name (str): Name of the JavaScript variable to assign.
+        labels (list): Column labels.
+        axis (numpy.ndarray): datetime64[s] dates of the rows.
+        values (list): Integer-valued float arrays, NaN for empty cells.
+    Returns:
+        JavaScript code string.
+
+    """
+    return "var {0} = new google.visualization.DataTable({1}, 0.6);".format(
+        name,
+        datatable(labels, axis, values),
+    )
+
+
+def fetch(st, thing, since, until, points=CHART_WIDTH, with_range=False):
+    """Read the temperature series of one thing, downsampled to about
+    `points` points.
+
+    Args:
+        st (SmartThings): Client of the account.
+        thing (dict): Thing to chart.
+        since (datetime): Start of charted window.
+        until (datetime): End of charted window.
+        points (Optional[int]): Points wanted.
+        with_range (Optional[bool]): Also read the date range of all stored
+            states of the series.
+    Returns:
+        Tuple of date array, value array and the date range, or None for
+        the range unless `with_range` is set.
+
+    """
+    rows = st.series(
+        thing_id=thing["id"],
+        state="temperature",
+        since=since,
+        until=until,
+        points=points,
+    )
+    with metrics.timer(metrics.RESULTS_QUERY_SECONDS):
+        dates_array, values = columns(rows)
+        # Read after series(), which syncs the states the range covers.
+        date_range = None
+        if with_range:
+            date_range = st.states_range(
+                thing_id=thing["id"],
+                state="temperature",
+            )
+    metrics.RESULTS_ROWS.inc(len(values))
+    logger.debug("Found rows: {0}".format(len(values)))
+    values = numpy.trunc(values)
+    keep = values < MAX_VALUE # NaN compares False, so is dropped too
+    dates_array, values = downsample.downsample(
+        dates_array[keep],
+        values[keep],
+        points,
+    )
+    return dates_array, values, date_range
+
+
+def _fetch(args):
+    """Call fetch() on a pool thread.
+
+    Returns:
+        Tuple of the result of fetch(), or None if it failed, and the timing
+        breakdown of the call, to be added to that of the request.
+
+    """
+    metrics.begin()
+    try:
+        result = fetch(*args)
+    except Exception:
+        logger.exception("_fetch: reading {0} failed".format(args[1]["id"]))
+        result = None
+    return result, metrics.end()
+
+
+def chart(st, things, since, until, points=CHART_WIDTH, bound=None):
+    """Read temperature series of things downsampled to about `points`
+    points each. Series are read concurrently on the shared pool() and
+    merged in the order of things.
+
+    Args:
+        st (SmartThings): Client of the account.
+        things (list): Things to chart.
+        since (datetime): Start of charted window.
+        until (datetime): End of charted window.
+        points (Optional[int]): Points wanted per series.
+        bound (Optional[dict]): Range with `min` and `max` keys to extend
+            with the date ranges of all stored states of the series.
+    Returns:
+        Tuple of labels, the shared date array and a list of value arrays,
+        as taken by jscode() and datatable().
+
+    """
+    fetched = []
+    for result, breakdown in pool().map(_fetch, [
+        (st, thing, since, until, points, bound is not None)
+        for thing in things
+    ]):
+        metrics.add(breakdown)
+        fetched.append(result)
+    labels = []
+    series = []
+    for thing, result in zip(things, fetched):
+        labels.append(thing["label"])
+        if result is None:
+            # Failure was logged; chart the series as empty.
+            result = (
+                numpy.array([], dtype="datetime64[s]"),
+                numpy.array([]),
+                None,
+            )
+        dates_array, values, date_range = result
+        series.append((dates_array, values))
+        if bound is not None and date_range is not None:
+            update_range(bound, date_range)
+    with metrics.timer(metrics.RESULTS_SERIALIZE_SECONDS):
+        axis, aligned = align(series)
+    return labels, axis, aligned
+
+
+DEFAULT_SINCE = datetime(2016, 4, 20)
+DEFAULT_UNTIL = datetime(2016, 4, 25)
+
+
+def results(token, since=None, until=None, read_only=False, points=CHART_WIDTH):
+    """Build chart data for an account's temperature sensors. Only the
+    initial window is included, downsampled; the page loads other windows
+    from window() as the date slider moves.
+
+    Args:
+        token (str): Access token of the account.
+        since (Optional[datetime]): Start of charted window.
+        until (Optional[datetime]): End of charted window.
+        read_only (Optional[bool]): Only read stored data; never call the API.
+        points (Optional[int]): Points wanted per series.
+    Returns:
+        Dictionary with `jscode` creating the chart DataTable, `dates`
+        holding the `bound` and `default` slider ranges in milliseconds, and
+        `updated` with the UTC time the charted data was last refreshed from
+        the API, the oldest of all series, or "never".
+
+    """
     logger.debug("results(%s)" % token)
-    st = SmartThings(token)
+    st = client(token, read_only=read_only)
 
     dates = {
         "bound": {
@@ -39,56 +302,41 @@ def results(token):
             "max": None,
         },
         "default": {
-            "min": datetime(2016, 4, 20),
-            "max": datetime(2016, 4, 25),
+            "min": since or DEFAULT_SINCE,
+            "max": until or DEFAULT_UNTIL,
         },
     }
 
-    description = { "Date": "datetime" }
-    data = []
-    columns_order=["Date"]
-    things = st.things("temperature")
-    for thing in things[:9]:
-        description[thing["label"]] = "number"
-        columns_order.append(thing["label"])
-        source_data = st.states(
-            thing_id=thing["id"],
-            state="temperature",
-            since=dates["default"]["min"],
-            until=dates["default"]["max"],
-        )
-        update_range(
-            dates["bound"],
-            st.states_range(
-                thing_id=thing["id"],
-                state="temperature",
-            ),
-        )
-        logger.debug(
-            "range is {0} to {1}"
-            .format(dates["bound"]["min"], dates["bound"]["max"])
-        )
-        #logger.debug("Processing thing: {0}".format(thing))
-        logger.debug("Found rows: {0}".format(source_data.count()))
-        for row in source_data[:]:
-            #logger.debug("Processing row: {0}".format(row))
-            if row["date"] is not None and row["value"] is not None:
-                value = int(float(row["value"]))
-                if value < 150:
-                    data.append({
-                        "Date": row["date"],
-                        thing["label"]: value,
-                    })
-    # logger.debug("Data: {0}".format(data))
-    # Load it into gviz_api.DataTable
-    data_table = gviz_api.DataTable(description)
-    data_table.LoadData(data)
-    # Create JavaScript code string
-    jscode = data_table.ToJSCode(
-        "jscode_data",
-        columns_order=columns_order,
-        order_by=columns_order[0],
+    things = list(st.things("temperature")[:MAX_THINGS])
+    labels, axis, aligned = chart(
+        st,
+        things,
+        dates["default"]["min"],
+        dates["default"]["max"],
+        points,
+        dates["bound"],
+    )
+    logger.debug(
+        "range is {0} to {1}"
+        .format(dates["bound"]["min"], dates["bound"]["max"])
     )
+    if dates["bound"]["min"] is None:
+        # No stored data; let the slider cover the default window.
+        dates["bound"] = dict(dates["default"])
+    with metrics.timer(metrics.RESULTS_SERIALIZE_SECONDS):
+        # Create JavaScript code string
+        code = jscode("jscode_data", labels, axis, aligned)
+
+    refreshed = [
+        x for x in (st.refreshed(thing["id"], "temperature") for thing in things)
+        if x is not None
+    ]
+    updated = "never"
+    if refreshed:
+        # Query times are recorded in local time.
+        updated = datetime.utcfromtimestamp(
+            mktime(min(refreshed).timetuple())
+        ).strftime("%Y-%m-%d %H:%M") + " UTC"
 
     jsdates = {
         "bound": {
@@ -103,4 +351,30 @@ def results(token):
 
 
 
-    return {"jscode": jscode, "dates": jsdates}
+    return {
+        "jscode":  code,
+        "dates":   jsdates,
+        "updated": updated,
+    }
+
+
+def window(token, since, until, points=CHART_WIDTH, read_only=False):
+    """Build chart data for one window of the date slider.
+
+    Args:
+        token (str): Access token of the account.
+        since (datetime): Start of the window.
+        until (datetime): End of the window.
+        points (Optional[int]): Points wanted per series, usually the chart
+            width in pixels.
+        read_only (Optional[bool]): Only read stored data; never call the API.
+    Returns:
+        JSON string of a google.visualization.DataTable.
+
+    """
+    logger.debug("window({0}, {1}, {2})".format(token, since, until))
+    st = client(token, read_only=read_only)
+    things = list(st.things("temperature")[:MAX_THINGS])
+    labels, axis, aligned = chart(st, things, since, until, points)
+    with metrics.timer(metrics.RESULTS_SERIALIZE_SECONDS):
+        return datatable(labels, axis, aligned)
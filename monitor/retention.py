@@ -0,0 +1,116 @@
+"""Retention of raw states, run with `tasks.py compact`. Raw states of an
+account older than its retention period are moved from MongoDB to the cold
+archive of `archive.py`, in segments of SEGMENT_DAYS days per series. Rollups
+and series summaries are kept, so charts of long ranges still read MongoDB
+only, and storage.store() reads archived states along with stored ones.
+
+The retention period is the `retention_days` of the account document, or
+RETENTION_DAYS if not set. A value of 0 keeps all states in MongoDB.
+
+Compaction can be rerun safely if interrupted: states before the end of the
+archived range of a series are deleted from MongoDB before anything newer is
+archived. States are only deleted once a segment holding all of them has been
+written: a write that checked the archived range just before the segment
+moved it can still land in the range, so the range is read again after
+writing and the segment rewritten until no such late states remain.
+
+"""
+import logging
+log = logging.getLogger(__name__)
+log.debug("retention.py loaded")
+
+from datetime import datetime, timedelta
+import storage
+
+
+RETENTION_DAYS = 90 # days raw states stay in MongoDB unless set per account
+SEGMENT_DAYS   = 30 # days of a series archived into one segment
+
+
+def retention_days(account):
+    """Return retention period of an account in days, 0 for no limit."""
+    days = account.get("retention_days")
+    return RETENTION_DAYS if days is None else days
+
+
+def compact_series(store, thing_id, state, first, cutoff):
+    """Archive states of one series before a cutoff.
+
+    Args:
+        store (storage.TieredStore): Stored and archived states.
+        thing_id (str): ID of the thing the states belong to.
+        state (str): Type of the states.
+        first (datetime): Date of the first stored state of the series.
+        cutoff (datetime): Start of a day; states before it are archived.
+    Returns:
+        Number of states archived.
+
+    """
+    since = store.cold.horizon(thing_id, state)
+    if since is not None:
+        # Finish any earlier run interrupted after writing a segment.
+        store.delete(thing_id, state, since)
+    else:
+        since = datetime(first.year, first.month, first.day)
+    archived = 0
+    while since < cutoff:
+        until = min(since + timedelta(days=SEGMENT_DAYS), cutoff)
+        states = list(store.hot.find(thing_id, state, since, until))
+        if states:
+            while True:
+                store.cold.write(thing_id, state, since, until, states)
+                # States only ever get added, so an unchanged count means
+                # none arrived since they were read.
+                latest = list(store.hot.find(thing_id, state, since, until))
+                if len(latest) == len(states):
+                    break
+                log.debug(
+                    "compact_series: {0} {1} got {2} late states"
+                    .format(thing_id, state, len(latest) - len(states))
+                )
+                states = latest
+            store.delete(thing_id, state, until)
+            archived += len(states)
+        since = until
+    return archived
+
+
+def compact(db, accounts, now=None):
+    """Archive raw states older than the retention period of each account.
+
+    Args:
+        db (pymongo.database.Database): Database holding the states.
+        accounts (list): Account documents with `token`.
+        now (Optional[datetime]): Current UTC time.
+    Returns:
+        Number of states archived.
+
+    """
+    now = now or datetime.utcnow()
+    store = storage.store(db)
+    archived = 0
+    for account in accounts:
+        days = retention_days(account)
+        if not days:
+            continue
+        cutoff = datetime(now.year, now.month, now.day) - timedelta(days=days)
+        thing_ids = [
+            x["id"] for x in
+            db.things.find({"token": account["token"]}, {"id": True})
+        ]
+        for summary in db.series.find(
+            {"thing_id": {"$in": thing_ids}, "first": {"$lt": cutoff}},
+        ):
+            count = compact_series(
+                store,
+                summary["thing_id"],
+                summary["state"],
+                summary["first"],
+                cutoff,
+            )
+            archived += count
+            log.debug(
+                "compact: Archived {0} states of {1} {2}."
+                .format(count, summary["thing_id"], summary["state"])
+            )
+    return archived
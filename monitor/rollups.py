@@ -0,0 +1,175 @@
+"""Time series rollups of numeric states. For every `(thing_id, state)` series,
+each rollup collection holds one document per time bucket with the count,
+sum, minimum and maximum of the values in that bucket. Rollups are updated
+incrementally by SmartThings._save_states() as new states are ingested, and
+can be rebuilt from scratch with `tasks.py rollups`.
+
+Readings at or above the ERROR_VALUES limit of their state are sensor errors
+and left out of rollups, as charts drop them from raw states. Rollups written
+before a limit was added still include them until rebuilt.
+
+"""
+import logging
+log = logging.getLogger(__name__)
+log.debug("rollups.py loaded")
+
+from pymongo import UpdateOne, ASCENDING
+import storage
+
+
+# (name, bucket size in seconds), coarsest first
+RESOLUTIONS = [
+    ("1d", 86400),
+    ("1h", 3600),
+    ("5m", 300),
+]
+MIN_POINTS = 300 # buckets a resolution must have to fill a requested range
+# state -> readings at or above this are sensor errors and not rolled up
+ERROR_VALUES = {
+    "temperature": 150,
+}
+
+
+def collection_name(resolution):
+    """Return name of the collection holding rollups at a resolution."""
+    return "states_{0}".format(resolution)
+
+
+def update(db, states):
+    """Add newly ingested states to all rollups. States must not have been
+    added before, since rollups cannot tell duplicates apart. States whose
+    values are not numeric or are sensor errors are skipped.
+
+    Args:
+        db (pymongo.database.Database): Database holding the rollups.
+        states (list): State documents with `thing_id`, `state`, `date` and
+            `value` keys.
+
+    """
+    for resolution, size in RESOLUTIONS:
+        buckets = {}
+        for item in states:
+            try:
+                value = float(item["value"])
+            except (TypeError, ValueError):
+                continue
+            if value >= ERROR_VALUES.get(item["state"], float("inf")):
+                continue
+            key = (
+                item["thing_id"],
+                item["state"],
+                storage.bucket(item["date"], size),
+            )
+            if key in buckets:
+                total = buckets[key]
+                total["count"] += 1
+                total["sum"]   += value
+                total["min"]    = min(total["min"], value)
+                total["max"]    = max(total["max"], value)
+            else:
+                buckets[key] = {
+                    "count": 1,
+                    "sum":   value,
+                    "min":   value,
+                    "max":   value,
+                }
+        if not buckets:
+            return
+        operations = []
+        for (thing_id, state, date), total in buckets.items():
+            operations.append(UpdateOne(
+                {
+                    "thing_id": thing_id,
+                    "state":    state,
+                    "date":     date,
+                },
+                {
+                    "$inc": {"count": total["count"], "sum": total["sum"]},
+                    "$min": {"min": total["min"]},
+                    "$max": {"max": total["max"]},
+                },
+                upsert=True,
+            ))
+        db[collection_name(resolution)].bulk_write(operations, ordered=False)
+        log.debug(
+            "update: Updated {0} {1} buckets."
+            .format(len(operations), resolution)
+        )
+
+
+def resolution(since, until, points=MIN_POINTS):
+    """Choose the coarsest resolution that still has at least `points`
+    buckets between since and until.
+
+    Args:
+        since (Optional[datetime]): Start of requested range.
+        until (Optional[datetime]): End of requested range.
+        points (Optional[int]): Minimum number of buckets needed.
+    Returns:
+        Name of the resolution, or None if raw states should be used.
+
+    """
+    if since is None or until is None:
+        return None
+    seconds = (until - since).total_seconds()
+    for name, size in RESOLUTIONS:
+        if seconds / size >= points:
+            return name
+    return None
+
+
+def series(db, thing_id, state, since, until, points=MIN_POINTS):
+    """Get values of one series between two dates at the coarsest resolution
+    that still fills the range, falling back to raw states.
+
+    Args:
+        db (pymongo.database.Database): Database holding states and rollups.
+        thing_id (str): Limit to the thing with this ID.
+        state (str): Limit to this type of state.
+        since (Optional[datetime]): Limit to results on or after this time.
+        until (Optional[datetime]): Limit to results before this time.
+        points (Optional[int]): Minimum number of points wanted.
+    Returns:
+        Iterable of dictionaries with `date` and `value` keys, sorted by date.
+        Values of rollups are bucket averages.
+
+    """
+    params = {
+        "thing_id": thing_id,
+        "state":    state,
+    }
+    date = {}
+    if since is not None:
+        date["$gte"] = since
+    if until is not None:
+        date["$lt"] = until
+    if date:
+        params["date"] = date
+    name = resolution(since, until, points)
+    log.debug("series: Using resolution {0}".format(name or "raw"))
+    if name is None:
+        return storage.store(db).find(thing_id, state, since, until)
+    cursor = db[collection_name(name)].find(
+        params,
+        {"_id": False, "date": True, "sum": True, "count": True},
+    ).sort("date", ASCENDING)
+    return (
+        {"date": x["date"], "value": x["sum"] / x["count"]}
+        for x in cursor
+    )
+
+
+def rebuild(db, batch_size=1000):
+    """Recompute all rollups from raw states of the configured storage
+    engine.
+
+    Args:
+        db (pymongo.database.Database): Database holding states and rollups.
+        batch_size (Optional[int]): Number of states to roll up at once.
+
+    """
+    for name, size in RESOLUTIONS:
+        db[collection_name(name)].delete_many({})
+    states = storage.store(db).scan(batch_size)
+    for batch in storage.batches(states, batch_size):
+        update(db, batch)
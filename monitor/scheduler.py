@@ -0,0 +1,257 @@
+"""Long running, adaptive poller run with `tasks.py schedule`. Instead of
+polling every series on a fixed cron schedule, every `(token, thing_id, state)`
+series has its own poll interval, kept in a priority queue ordered by next
+poll time.
+
+After each poll the interval is adapted to the series' observed rate of new
+states, aiming for TARGET_ROWS states per poll: chatty series such as power
+meters are polled often enough to stay under the SmartApp's page cap, and idle
+series such as switches back off to MAX_INTERVAL. A poll whose first page was
+full shortens the interval sharply. Requests of each account share its
+RateBudget from poller.py, and at most `per_account` series of an account are
+polled at once.
+
+Each poll fetches states since the newest state of the series fetched by
+polling, less OVERLAP, so states are never skipped however late a poll runs. A poll that
+fails part way is retried without moving the series' poll time.
+
+The schedule is kept in the `schedule` collection, so a restarted scheduler
+picks up where it left off.
+
+"""
+import logging
+log = logging.getLogger(__name__)
+log.debug("scheduler.py loaded")
+
+import heapq
+import Queue
+import time
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+import poller
+import smartthings
+
+
+MIN_INTERVAL      = 300    # seconds between polls of the chattiest series
+MAX_INTERVAL      = 86400  # seconds between polls of idle series
+DEFAULT_INTERVAL  = 3600   # seconds between polls of new series
+TARGET_ROWS       = smartthings.PAGE_SIZE // 4 # states wanted per poll
+DISCOVER_INTERVAL = 3600   # seconds between scans for new accounts and series
+OVERLAP           = 60     # seconds polled before the last polled state
+DEFER             = 5      # seconds to postpone a series of a busy account
+
+
+def next_interval(interval, rows, elapsed, full):
+    """Adapt the poll interval of a series to its latest poll.
+
+    Args:
+        interval (float): Current interval in seconds.
+        rows (int): Number of states returned by the poll.
+        elapsed (Optional[float]): Seconds covered by the poll, or None if
+            the series was never polled before.
+        full (bool): Whether the first page returned was full.
+    Returns:
+        New interval in seconds.
+
+    """
+    if full:
+        # States were coming in faster than a page per poll.
+        interval /= 4.0
+    elif rows and elapsed:
+        wanted = TARGET_ROWS / (float(rows) / elapsed)
+        # Move halfway to the wanted interval to damp bursts.
+        interval = (interval + wanted) / 2.0
+    elif elapsed:
+        interval *= 2
+    return min(max(interval, MIN_INTERVAL), MAX_INTERVAL)
+
+
+def poll(entry, budget=None):
+    """Fetch new states of one series.
+
+    Args:
+        entry (dict): Schedule document of the series.
+        budget (Optional[RateBudget]): Budget of the account's requests.
+            Default: the account's budget in this process.
+    Returns:
+        Tuple of the entry, stats returned by SmartThings.sync_states() or
+        None if polling failed, and the UTC time the poll started.
+
+    """
+    started = datetime.utcnow()
+    try:
+        st = smartthings.client(entry["token"])
+        if budget is None:
+            budget = poller.budget(entry["token"])
+        st.budget = budget
+        since = st.last_polled(entry["thing_id"], entry["state"])
+        if since is not None:
+            since -= timedelta(seconds=OVERLAP)
+        stats = st.sync_states(entry["thing_id"], entry["state"], since=since)
+    except Exception:
+        log.exception(
+            "poll: {0} {1} failed".format(entry["thing_id"], entry["state"])
+        )
+        stats = None
+    if stats is not None and stats["failed"]:
+        # The polled high-water mark did not move, so the retry fetches it.
+        stats = None
+    return entry, stats, started
+
+
+class Scheduler(object):
+    """Priority queue of series, polled on a pool of threads as they come due.
+    """
+
+    def __init__(self, workers=poller.ACCOUNT_WORKERS * poller.SERIES_WORKERS,
+                 per_account=poller.SERIES_WORKERS):
+        """Set up an empty scheduler.
+
+        Args:
+            workers (Optional[int]): Series polled at once in total.
+            per_account (Optional[int]): Series polled at once per account.
+        """
+        self._workers = workers
+        self._per_account = per_account
+        self._heap = []
+        self._entries = {}
+        self._running = {}
+        self._done = Queue.Queue()
+        self._pool = None
+        self._discovered = 0
+
+    def load(self):
+        """Read the persisted schedule into the queue."""
+        for entry in smartthings.db.schedule.find({}, {"_id": False}):
+            self._push(entry)
+        log.debug("load: Loaded {0} series.".format(len(self._entries)))
+
+    def _push(self, entry):
+        """Queue a series by its next poll time."""
+        key = (entry["token"], entry["thing_id"], entry["state"])
+        self._entries[key] = entry
+        heapq.heappush(self._heap, (entry["next"], key))
+
+    def discover(self):
+        """Add series of connected accounts missing from the schedule, and
+        drop series whose things or accounts are gone.
+        """
+        now = datetime.utcnow()
+        found = set()
+        for account in smartthings.accounts():
+            token = account["token"]
+            try:
+                st = smartthings.client(token)
+                st.budget = poller.budget(token)
+                for thing in st.things("all"):
+                    for attribute in smartthings.attributes(thing):
+                        found.add((token, thing["id"], attribute))
+            except Exception:
+                log.exception("discover: listing things failed")
+                # Keep the account's series rather than dropping them.
+                found.update(k for k in self._entries if k[0] == token)
+        for key in set(found) - set(self._entries):
+            entry = {
+                "token":    key[0],
+                "thing_id": key[1],
+                "state":    key[2],
+                "next":     now,
+                "interval": DEFAULT_INTERVAL,
+                "polled":   None,
+            }
+            smartthings.db.schedule.update_one(
+                {"token": key[0], "thing_id": key[1], "state": key[2]},
+                {"$setOnInsert": entry},
+                upsert=True,
+            )
+            self._push(entry)
+        for key in set(self._entries) - found:
+            smartthings.db.schedule.delete_one(
+                {"token": key[0], "thing_id": key[1], "state": key[2]}
+            )
+            # Its queued item is skipped when popped.
+            del self._entries[key]
+        self._discovered = time.time()
+        log.debug("discover: Scheduling {0} series.".format(len(self._entries)))
+
+    def _finish(self, entry, stats, started):
+        """Reschedule a polled series and persist its new schedule."""
+        key = (entry["token"], entry["thing_id"], entry["state"])
+        self._running[key[0]] -= 1
+        if key not in self._entries:
+            return # dropped by discover() while polling
+        if stats is None:
+            # Retry soon, without adapting to a failed poll.
+            entry["next"] = datetime.utcnow() + timedelta(seconds=MIN_INTERVAL)
+        else:
+            elapsed = None
+            if entry.get("polled") is not None:
+                elapsed = (started - entry["polled"]).total_seconds() + OVERLAP
+            entry["interval"] = next_interval(
+                entry["interval"],
+                stats["rows"],
+                elapsed,
+                stats["full"],
+            )
+            entry["polled"] = started
+            entry["next"] = started + timedelta(seconds=entry["interval"])
+        smartthings.db.schedule.update_one(
+            {"token": key[0], "thing_id": key[1], "state": key[2]},
+            {"$set": {
+                "next":     entry["next"],
+                "interval": entry["interval"],
+                "polled":   entry["polled"],
+            }},
+        )
+        self._push(entry)
+
+    def _start_due(self):
+        """Start polls of due series while workers are free.
+
+        Returns:
+            Seconds until the next series is due, or None if none queued.
+        """
+        deferred = []
+        now = datetime.utcnow()
+        while self._heap and sum(self._running.values()) < self._workers:
+            due, key = self._heap[0]
+            if due > now:
+                break
+            heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+            if entry is None or entry["next"] != due:
+                continue # dropped or rescheduled since queued
+            if self._running.get(key[0], 0) >= self._per_account:
+                deferred.append(entry)
+                continue
+            self._running[key[0]] = self._running.get(key[0], 0) + 1
+            self._pool.apply_async(poll, (entry,), callback=self._done.put)
+        for entry in deferred:
+            entry["next"] = now + timedelta(seconds=DEFER)
+            self._push(entry)
+        if not self._heap:
+            return None
+        return max((self._heap[0][0] - now).total_seconds(), 0)
+
+    def run(self):
+        """Poll series as they come due, forever."""
+        self._pool = ThreadPool(self._workers)
+        self.load()
+        while True:
+            if time.time() - self._discovered >= DISCOVER_INTERVAL:
+                self.discover()
+            wait = self._start_due()
+            if wait is None or sum(self._running.values()) >= self._workers:
+                wait = DISCOVER_INTERVAL
+            try:
+                # Wake up for whichever comes first: a finished poll, the
+                # next due series or the next discovery.
+                result = self._done.get(timeout=min(wait, DISCOVER_INTERVAL, 60))
+            except Queue.Empty:
+                continue
+            self._finish(*result)
+            while True:
+                try:
+                    self._finish(*self._done.get_nowait())
+                except Queue.Empty:
+                    break
@@ -0,0 +1,100 @@
+"""Session store caching another store, such as MongoStore, in process.
+
+Session data read from the wrapped store is kept for SESSION_TTL seconds, so a
+burst of requests, such as a page and the windows its chart loads, reads the
+session once. Writes go through to the wrapped store, except when the session
+did not change since this process last wrote it, unless SESSION_TOUCH seconds
+have passed so the stored copy is not cleaned up as idle. Write times are kept
+apart from the cached data, so reading a session again after SESSION_TTL does
+not postpone its touch. Sessions of anonymous
+visitors are written once like any other, since web.py gives a session
+missing from the store a new ID, and a new cookie, on every request.
+
+Other processes may keep serving a cached copy of a session, including one
+that was logged out, for up to SESSION_TTL seconds after it changes.
+
+"""
+import logging
+log = logging.getLogger(__name__)
+log.debug("sessions.py loaded")
+
+import copy
+import time
+import web
+import cache
+
+
+SESSION_CACHE_SIZE = 1000 # sessions kept in memory
+SESSION_TTL        = 5    # seconds a cached session is trusted
+SESSION_TOUCH      = 300  # seconds after which unchanged sessions are rewritten
+
+
+class CachedStore(web.session.Store):
+    """Write through cache in front of a web.session.Store."""
+
+    def __init__(self, store, size=SESSION_CACHE_SIZE, ttl=SESSION_TTL,
+                 touch=SESSION_TOUCH):
+        """Set up empty cache.
+
+        Args:
+            store (web.session.Store): Store holding the sessions.
+            size (Optional[int]): Maximum number of cached sessions.
+            ttl (Optional[float]): Seconds a cached session is trusted.
+            touch (Optional[float]): Seconds after which an unchanged session
+                is written again.
+        """
+        self.store = store
+        self._cache = cache.TTLCache(size, ttl)
+        self._written = cache.LRUCache(size) # session ID -> last write time
+        self._touch = touch
+
+    def _lookup(self, key):
+        """Return cache entry of a session, reading it from the store if not
+        cached. Entries of missing sessions have a `value` of None.
+        """
+        entry = self._cache.get((key,))
+        if entry is None:
+            try:
+                value = self.store[key]
+            except KeyError:
+                value = None
+            entry = {"value": value}
+            self._cache.set((key,), entry)
+        return entry
+
+    def __contains__(self, key):
+        return self._lookup(key)["value"] is not None
+
+    def __getitem__(self, key):
+        value = self._lookup(key)["value"]
+        if value is None:
+            raise KeyError(key)
+        return copy.deepcopy(value)
+
+    def __setitem__(self, key, value):
+        now = time.time()
+        entry = self._cache.get((key,))
+        written = self._written.get((key,))
+        if entry is not None and entry["value"] == value \
+                and written is not None and now - written < self._touch:
+            return
+        self.store[key] = value
+        self._cache.set((key,), {"value": copy.deepcopy(value)})
+        self._written.set((key,), now)
+
+    def __delitem__(self, key):
+        self._cache.invalidate(key)
+        self._written.invalidate(key)
+        try:
+            del self.store[key]
+        except KeyError:
+            pass
+
+    def cleanup(self, timeout):
+        self.store.cleanup(timeout)
+
+    def encode(self, session_dict):
+        return self.store.encode(session_dict)
+
+    def decode(self, session_data):
+        return self.store.decode(session_data)
@@ -2,20 +2,241 @@ import logging
 log = logging.getLogger(__name__)
 log.debug("smartthings.py loaded")
 
+import binascii
+import codecs
+import hashlib
 import json
+import os
+import threading
+import time
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth2Session
 import pymongo
+import cache
+import ledger
+import metrics
+import rollups
+import storage
+import summaries
+from pymongo import ReplaceOne, UpdateOne
 from datetime import datetime, timedelta
 
 
 db = pymongo.MongoClient().monitor
 
+PAGE_SIZE     = 1000  # maximum states the SmartApp returns per request
+BATCH_SIZE    = 500   # streamed items written to the database at once
+STREAM_CHUNK  = 8192  # bytes of a response decoded at once
+POOL_SIZE     = 10    # keep-alive API connections per host, shared by all clients
+CLIENT_IDLE   = 600   # seconds after which an unused client is evicted
+BATCH_SERIES  = 25    # series requested at once with function=batchStates
+BATCH_MAX     = 200   # states per series returned by function=batchStates
+
+# HTTP connection pool shared by the sessions of all clients.
+adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+_credentials = {}
+_accounts = {}
+_clients = {}
+_registry_lock = threading.Lock()
+# Times of API calls, answered from memory and written behind to db.calls.
+calls = ledger.ledger(db.calls)
+
+
+def credentials(filename):
+    """Load client ID, client secret and redirect URI from file, reading the
+    file only once per process.
+
+    Args:
+        filename (str): JSON file holding the credentials.
+    Returns:
+        Dictionary of credentials.
+
+    """
+    with _registry_lock:
+        if filename not in _credentials:
+            with open(filename) as data:
+                _credentials[filename] = json.load(data)
+        return _credentials[filename]
+
+
+def account(token):
+    """Get account document, reading it from the database only once while a
+    client of the account is in use.
+
+    Args:
+        token (str): Access token of the account.
+    Returns:
+        Account document.
+
+    """
+    with _registry_lock:
+        document = _accounts.get(token)
+    if document is None:
+        document = db.accounts.find_one({"token": token})
+        with _registry_lock:
+            _accounts[token] = document
+    return document
+
+
+def client(token, read_only=False):
+    """Get shared SmartThings client for an account, creating it if needed.
+    Clients unused for CLIENT_IDLE seconds are evicted along with their
+    cached account documents.
+
+    Args:
+        token (str): Access token of the account.
+        read_only (Optional[bool]): Get a client that never calls the API
+            for data. See SmartThings.
+
+    Returns:
+        SmartThings instance.
+
+    """
+    now = time.time()
+    key = (token, read_only)
+    with _registry_lock:
+        for idle_key, (idle_client, used) in _clients.items():
+            if now - used > CLIENT_IDLE and idle_key != key:
+                del _clients[idle_key]
+                if not any(k[0] == idle_key[0] for k in _clients):
+                    _accounts.pop(idle_key[0], None)
+        if key in _clients:
+            st = _clients[key][0]
+            _clients[key] = (st, now)
+            return st
+    st = SmartThings(token, read_only=read_only)
+    with _registry_lock:
+        # Another thread may have created one meanwhile; keep the first.
+        st = _clients.setdefault(key, (st, now))[0]
+    return st
+
+
+def seconds(date):
+    """Return seconds since epoch of a naive UTC datetime, as used by the API."""
+    return (date - datetime(1970, 1, 1)).total_seconds()
+
+
+def iter_items(response, chunk_size=STREAM_CHUNK):
+    """Decode a JSON array from a streamed response one item at a time, so
+    memory use does not grow with the size of the response.
+
+    Args:
+        response (requests.Response): Response made with `stream=True`.
+        chunk_size (Optional[int]): Bytes to read at once.
+    Returns:
+        Iterator of decoded items.
+    Raises:
+        ValueError: If the body is not a complete JSON array.
+
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer = u""
+    started = False
+    try:
+        for chunk in response.iter_content(chunk_size):
+            buffer += text.decode(chunk)
+            position = 0
+            while True:
+                while position < len(buffer) and buffer[position] in u" \t\r\n,":
+                    position += 1
+                if position >= len(buffer):
+                    break
+                if not started:
+                    if buffer[position] != u"[":
+                        raise ValueError("Response is not a JSON array")
+                    started = True
+                    position += 1
+                    continue
+                if buffer[position] == u"]":
+                    return
+                try:
+                    item, end = decoder.raw_decode(buffer, position)
+                except ValueError:
+                    break # item is incomplete; read more
+                following = buffer[end:end + 1]
+                if not isinstance(item, (dict, list)) and (
+                        not following or following not in u" \t\r\n,]"):
+                    break # a number may continue in the next chunk
+                yield item
+                position = end
+            buffer = buffer[position:]
+    finally:
+        response.close()
+    raise ValueError("Response ended inside JSON array")
+
 
 def accounts():
     """Return all accounts with token, meaning they have been connected to API."""
     return [x for x in db.accounts.find() if x["token"] is not None]
 
 
+def modified(token):
+    """Return time data was last written for an account.
+
+    Args:
+        token (str): Access token of the account.
+    Returns:
+        UTC datetime of last write of things or states, or None if unknown.
+
+    """
+    account = db.accounts.find_one({"token": token}, {"modified": True})
+    if account:
+        return account.get("modified")
+    return None
+
+
+def push_key(token):
+    """Get the key the SmartApp of an account sends with pushed states,
+    creating it on first use.
+
+    Args:
+        token (str): Access token of the account.
+    Returns:
+        Key as a hexadecimal string.
+
+    """
+    document = db.accounts.find_one({"token": token}, {"push_key": True})
+    if document and document.get("push_key"):
+        return document["push_key"]
+    db.accounts.update_one(
+        {"token": token, "push_key": {"$exists": False}},
+        {"$set": {"push_key": binascii.hexlify(os.urandom(16))}},
+    )
+    # Another process may have set a key meanwhile; use whichever won.
+    return db.accounts.find_one({"token": token}, {"push_key": True})["push_key"]
+
+
+def request_refresh(token):
+    """Queue an account for refreshing from the API by `tasks.py worker`.
+    An account is queued at most once until the worker picks it up.
+
+    Args:
+        token (str): Access token of the account.
+    """
+    db.refreshes.update_one(
+        {"token": token},
+        {"$setOnInsert": {"requested": datetime.utcnow()}},
+        upsert=True,
+    )
+
+
+def next_refresh():
+    """Remove and return the longest waiting queued account refresh.
+
+    Returns:
+        Access token of the account, or None if the queue is empty.
+
+    """
+    document = db.refreshes.find_one_and_delete(
+        {},
+        sort=[("requested", pymongo.ASCENDING)],
+    )
+    if document:
+        return document["token"]
+    return None
+
+
 def delete_docs(collection=None):
     """TODO DOCS Delete all documents, clearing history and accounts."""
     if collection is None or collection is "accounts":
@@ -24,6 +245,7 @@ def delete_docs(collection=None):
         db.things.delete_many({})
     if collection is None or collection is "states":
         db.states.delete_many({})
+        db.state_buckets.delete_many({})
     if collection is None or collection is "calls":
         db.calls.delete_many({})
     if collection is "users":
@@ -37,8 +259,14 @@ class SmartThings(object):
     such as states.
     """
 
-    def __init__(self, token=None):
-        """Set up instance and prepare to make API requests if token given."""
+    def __init__(self, token=None, read_only=False):
+        """Set up instance and prepare to make API requests if token given.
+
+        Args:
+            token (Optional[str]): Access token of a connected account.
+            read_only (Optional[bool]): Never call the API for data. Stale
+                data is instead queued for refresh by `tasks.py worker`.
+        """
         log.debug("SmartThings initialized using token {0}".format(token))
         api_base = "https://graph.api.smartthings.com/"
         self._options = {
@@ -53,15 +281,18 @@ class SmartThings(object):
         self._token_dict = None
         self._oauth = {}
         self._endpoint = []
+        self._read_only = read_only
+        # Optional rate limit budget shared by all users of this account,
+        # such as poller.RateBudget. Without one, rate limits are handled
+        # by sleeping in _get().
+        self.budget = None
         if self._token: self._load(self._token)
         self._load_credentials()
         self._start_session()
 
     def _load_credentials(self):
         """Load client ID, client secret and redirect URI from file."""
-        filename = self._options["client_file"]
-        with open(filename) as data:
-            self._credentials = json.load(data)
+        self._credentials = credentials(self._options["client_file"])
 
     def _start_session(self):
         """Start OAuth2 session using stored credentials and token."""
@@ -72,6 +303,8 @@ class SmartThings(object):
             scope=self._options["scope"],
             token=self._token_dict,
         )
+        self._oauth.mount("https://", adapter)
+        self._oauth.mount("http://", adapter)
 
     def auth_url(self):
         """Get URL for obtaining OAuth2 token."""
@@ -127,6 +360,8 @@ class SmartThings(object):
                 },
                 upsert=True,
             )
+            with _registry_lock:
+                _accounts.pop(self._token, None)
 
     def _load(self, token):
         """Get token data and endpoint from database for given token.
@@ -134,17 +369,27 @@ class SmartThings(object):
         Args:
             token (str): Token from account we want to retrieve full data.
         """
-        account = db.accounts.find_one(
-            {"token": token},
+        document = account(token)
+        self._token_dict = document['token_dict']
+        self._endpoint   = document['endpoint']
+
+    def _touch(self):
+        """Record that things or states of this account changed, and drop
+        cached results computed from the old data.
+        """
+        db.accounts.update_one(
+            {"token": self.token()},
+            {"$set": {"modified": datetime.utcnow()}},
         )
-        self._token_dict = account['token_dict']
-        self._endpoint   = account['endpoint']
+        cache.invalidate(self.token())
 
-    def _get_query_time(self, params):
-        """Get time of last query with given params.
+    def _get_query_time(self, params, cutoff=None):
+        """Get time of last query with given params from the call ledger.
 
         Args:
             params (dict): Data characterizing a query.
+            cutoff (Optional[datetime]): Query times after this are trusted
+                from memory without checking the database.
 
         Returns:
             datetime.datetime matching last query or Jan. 1, 1900, if no cache.
@@ -156,10 +401,9 @@ class SmartThings(object):
             token=self.token(),
         )
         # get existing query record
-        document = db.calls.find_one(params)
-        if document and "date" in document:
-            # return date of original record
-            return document["date"]
+        date = calls.get(params, cutoff)
+        if date is not None:
+            return date
         # arbitrary old date since no record exists
         return datetime(1900, 1, 1)
 
@@ -177,47 +421,64 @@ class SmartThings(object):
             params,
             token=self.token(),
         )
-        # Update or insert query record with now().
-        db.calls.update_one(
-            params,
-            {"$set": {"date": datetime.now()}},
-            upsert=True,
-        )
+        # Record now() in ledger, which writes it to the database later.
+        calls.set(params, datetime.now())
 
-    def _get(self, params, freshness=120):
-        """Get data from API if cache for given params is stale. Uses
-        _get_query_time() and _set_query_time() to determine staleness.
+    def _due(self, params, freshness=120):
+        """Check whether cached data for given params is stale and an API call
+        should be made. In read only mode, stale data is queued for refresh
+        instead.
 
         Args:
-            params (dict): Parameters for the API request. Key `function` is the
-                type of data desired, such as `things` or `states`.
+            params (dict): Data characterizing a query.
             freshness (Optional[int]): Number of minutes after which a new API
                 call will be made.
 
         Returns:
-            Response if new API call was made or None if cache is fresh.
+            datetime.datetime of last query if a call should be made, or None.
 
         """
-        last_datetime = self._get_query_time(params)
-        # Add "since" to params unless we're just getting thing list.
-        if "function" in params and params["function"] is not "things":
-            last_delta = last_datetime - datetime(1970, 1, 1)
-            params["since"] = last_delta.total_seconds()
-            #params["since"] = 0 # TODO REMOVE THIS LINE AFTER DATA REGATHERED
-        # Check if cache is fresh enough to skip API.
         cutoff = datetime.now() - timedelta(minutes = freshness)
+        last_datetime = self._get_query_time(params, cutoff)
+        # Check if cache is fresh enough to skip API.
         if last_datetime and last_datetime > cutoff:
             log.debug(
-                "_get: Skipping; got {0} within {1} minutes."
+                "_due: Skipping; got {0} within {1} minutes."
                 .format(params["function"].encode("utf-8"), freshness)
             )
             return None # TODO UNCOMMENT THIS LINE AFTER DATA REGATHERED
-        # Check for rate limiting.
+        if self._read_only:
+            log.debug("_due: Read only; queueing refresh.")
+            request_refresh(self.token())
+            return None
+        return last_datetime
+
+    def _request(self, params, stream=False):
+        """Make API request, waiting out any rate limiting.
+
+        Args:
+            params (dict): Parameters for the API request.
+            stream (Optional[bool]): Leave body unread, for iter_items().
+
+        Returns:
+            Response other than HTTP 429.
+
+        """
+        function = params.get("function")
         while True:
-            response = self._oauth.request(
-                "get",
-                self.endpoint(),
-                params=params
+            if self.budget is not None:
+                with metrics.timer(metrics.API_WAIT_SECONDS):
+                    self.budget.acquire()
+            with metrics.timer(metrics.API_SECONDS, function=function):
+                response = self._oauth.request(
+                    "get",
+                    self.endpoint(),
+                    params=params,
+                    stream=stream,
+                )
+            metrics.API_RESPONSES.inc(
+                function=function,
+                status=response.status_code,
             )
             # Extract needed HTTP headers to variables.
             limit, current, ttl = [
@@ -225,19 +486,47 @@ class SmartThings(object):
                 for k in ['limit', 'current', 'ttl']
             ]
             log.debug(
-                "_get: Limit {0}, Current {1}, TTL {2}"
+                "_request: Limit {0}, Current {1}, TTL {2}"
                 .format(limit, current, ttl)
             )
-            if(response.status_code == 429):
-                log.debug("_get: RATE LIMITED, waiting...")
-                import time
-                if ttl:
-                    time.sleep(ttl)
-                else:
-                    time.sleep(1)
+            if self.budget is not None:
+                self.budget.update(limit, current, ttl)
+            if(response.status_code != 429):
+                return response
+            log.debug("_request: RATE LIMITED, waiting...")
+            response.close()
+            wait = float(ttl) if ttl else 1
+            if self.budget is not None:
+                self.budget.block(wait)
             else:
-                self._set_query_time(params)
-                break
+                with metrics.timer(metrics.API_WAIT_SECONDS):
+                    time.sleep(wait)
+
+    def _get(self, params, freshness=120, stream=False):
+        """Get data from API if cache for given params is stale. Uses
+        _get_query_time() and _set_query_time() to determine staleness; the
+        query time is only recorded for a successful response.
+
+        Args:
+            params (dict): Parameters for the API request. Key `function` is the
+                type of data desired, such as `things` or `states`.
+            freshness (Optional[int]): Number of minutes after which a new API
+                call will be made.
+            stream (Optional[bool]): Leave body unread, for iter_items().
+
+        Returns:
+            Response if new API call was made or None if cache is fresh.
+
+        """
+        last_datetime = self._due(params, freshness)
+        if last_datetime is None:
+            return None
+        # Add "since" to params unless we're just getting thing list.
+        if "function" in params and params["function"] is not "things":
+            params["since"] = seconds(last_datetime)
+        response = self._request(params, stream)
+        if response.status_code == 200:
+            self._set_query_time(params)
         return response
 
     def things(self, kind="all", refresh=False):
@@ -256,42 +545,133 @@ class SmartThings(object):
             "function": "things",
             "kind": kind,
         }
-        response = self._get(params, freshness)
-        if response is not None:
-            data = [x for x in response.json() if x is not None]
-            # instead of figuring out which things no longer get returned,
-            # set all "active" fields to false first and add with true
-            db.things.update_many(
-                { "token": self.token() },
-                { "$set": {
-                        "active": False,
-                    }
-                },
-            )
-            # insert retrieved things into database
-            inserted_count = 0
-            for item in data:
-                item["token"]  = self.token()
-                item["active"] = True
-                result = db.things.replace_one(
-                    {
-                        "token": self.token(),
-                        "id":    item["id"],
-                    },
-                    item,
-                    upsert=True,
-                )
-                if result.upserted_id:
-                    inserted_count += 1
-            log.debug(
-                "things: Saved {0} things: {1} new, {2} replaced."
-                .format(len(data), inserted_count, len(data) - inserted_count)
+        response = self._get(params, freshness, stream=True)
+        if response is not None and response.status_code != 200:
+            response.close()
+            log.error(
+                "things: {0} returned HTTP {1}"
+                .format(kind, response.status_code)
             )
+        elif response is not None:
+            self.sync_things(kind, iter_items(response))
         # Get final data from database
-        return db.things.find({
+        query = {
             "active": True,
             "token":  self.token(),
-        })
+        }
+        # Read fresh, since another process may have synced the kind.
+        synced = db.accounts.find_one(
+            {"token": self.token()},
+            {"_id": False, "synced_kinds": True},
+        )
+        synced = (synced or {}).get("synced_kinds", [])
+        if kind != "all" and kind in synced:
+            # Until a kind is synced, stored things do not record it, so
+            # all active things are returned as before things had kinds.
+            query["kinds"] = kind
+        return db.things.find(query)
+
+    def sync_things(self, kind, items):
+        """Bring stored things of a kind in line with those returned by the
+        API, writing only things that were added, changed or removed. Things
+        are compared by a fingerprint of their content, and each remembers
+        the kinds it was returned for. The account records each kind synced,
+        so things() knows when it can filter by kind.
+
+        Args:
+            kind (str): Kind of things requested.
+            items (iterable): Things as decoded from the API response.
+        Returns:
+            Dictionary with lists of `added`, `changed` and `removed` thing
+            IDs.
+
+        """
+        stored = {}
+        for thing in db.things.find(
+            {"token": self.token()},
+            {"_id": False, "id": True, "fingerprint": True, "kinds": True,
+             "active": True},
+        ):
+            stored[thing["id"]] = thing
+        diff = {
+            "added":   [],
+            "changed": [],
+            "removed": [],
+        }
+        operations = []
+        seen = set()
+        count = 0
+        for item in items:
+            if item is None:
+                continue
+            count += 1
+            seen.add(item["id"])
+            existing = stored.get(item["id"])
+            kinds = set(existing.get("kinds", [])) if existing else set()
+            item["fingerprint"] = fingerprint(item)
+            active = existing is not None and existing.get("active", False)
+            if active and kind in kinds \
+                    and existing.get("fingerprint") == item["fingerprint"]:
+                continue
+            diff["changed" if active else "added"].append(item["id"])
+            kinds.add(kind)
+            item["token"]  = self.token()
+            item["active"] = True
+            item["kinds"]  = sorted(kinds)
+            operations.append(ReplaceOne(
+                {
+                    "token": self.token(),
+                    "id":    item["id"],
+                },
+                item,
+                upsert=True,
+            ))
+        for thing_id, existing in stored.items():
+            if thing_id in seen:
+                continue
+            if kind == "all":
+                if not existing.get("active", False):
+                    continue
+            elif kind not in existing.get("kinds", []):
+                continue
+            diff["removed"].append(thing_id)
+            if kind == "all":
+                # No longer selected in the SmartApp at all.
+                update = {"$set": {"active": False, "kinds": []}}
+            else:
+                update = {"$pull": {"kinds": kind}}
+            operations.append(UpdateOne(
+                {
+                    "token": self.token(),
+                    "id":    thing_id,
+                },
+                update,
+            ))
+        metrics.INGEST_ROWS.inc(count, collection="things")
+        if operations:
+            with metrics.timer(metrics.DB_SECONDS, collection="things"):
+                result = db.things.bulk_write(operations, ordered=False)
+            metrics.INGEST_WRITES.inc(result.upserted_count, collection="things")
+            self._touch()
+        if kind not in (account(self.token()) or {}).get("synced_kinds", []):
+            # Stored things now record whether they are of this kind.
+            db.accounts.update_one(
+                {"token": self.token()},
+                {"$addToSet": {"synced_kinds": kind}},
+            )
+            with _registry_lock:
+                _accounts.pop(self.token(), None)
+        log.debug(
+            "things: Synced {0} {1} things: {2} added, {3} changed, {4} removed."
+            .format(
+                count,
+                kind,
+                len(diff["added"]),
+                len(diff["changed"]),
+                len(diff["removed"]),
+            )
+        )
+        return diff
 
     def thing(self, thing_id):
         """Get thing with a given ID.
@@ -307,39 +687,87 @@ class SmartThings(object):
             "id":    thing_id,
         })
 
+    def refreshed(self, thing_id, state):
+        """Get time states of a series were last fetched from the API, by
+        this or any other process.
+
+        Args:
+            thing_id (str): ID of the thing.
+            state (str): Type of state.
+        Returns:
+            datetime in local time, or None if never fetched.
+
+        """
+        return calls.get({
+            "function": "states",
+            "thing_id": thing_id,
+            "state":    state,
+            "token":    self.token(),
+        })
+
     def states_range(self, thing_id, state=None):
-        """Get date range of stored states for the thing with a given ID.
+        """Get date range of stored states for the thing with a given ID from
+        its series summaries, without querying the API or scanning states.
 
         Args:
             thing_id (str): Limit to the thing with this ID.
             state (Optional[str]): Limit to this type of state.
         Returns:
             Dictionary with `min` and `max` keys corresponding to dates of
-            the extreme data points for specified state.
+            the extreme data points for specified state, or None if no
+            states are stored.
 
         """
-        # First update local database from API.
-        self.states(thing_id, state)
-        # Query local database for all states sorted by date.
-        params = {
-            "thing_id": thing_id,
-        }
-        if state is not None:
-            params["state"] = state
-        cursor = db.states.find(params).sort([
-            ("date", pymongo.ASCENDING),
-        ])
-        # Return dates of first and last items.
-        return {
-            "min": cursor[0]["date"],
-            "max": cursor[cursor.count()-1]["date"],
-        }
+        result = summaries.date_range(db, thing_id, state)
+        if result is not None:
+            return result
+        # No summary yet, such as before `tasks.py summaries` has been run.
+        return storage.store(db).date_range(thing_id, state)
+
+    def last_polled(self, thing_id, state):
+        """Get date of the newest state fetched by polling a series, from
+        which polling resumes. Pushed states are not counted, since the
+        SmartApp may have failed to push states before them.
+
+        Args:
+            thing_id (str): ID of the thing.
+            state (str): Type of state.
+        Returns:
+            datetime, or None if the series was never polled.
+
+        """
+        summary = db.series.find_one(
+            {"thing_id": thing_id, "state": state},
+            {"last": True, "polled_last": True},
+        )
+        if summary is None:
+            return None
+        # Series not polled since polled_last was added resume from the
+        # last stored state.
+        return summary.get("polled_last", summary.get("last"))
+
+    def _set_polled(self, thing_id, state, newest):
+        """Record the newest state fetched by polling a series up to now,
+        after all states since the previous one were fetched.
+
+        Args:
+            thing_id (str): ID of the thing.
+            state (str): Type of state.
+            newest (Optional[datetime]): Date of the newest state fetched.
+        """
+        if newest is None:
+            return
+        # The summary exists, since the states were saved.
+        db.series.update_one(
+            {"thing_id": thing_id, "state": state},
+            {"$max": {"polled_last": newest}},
+        )
 
     def states(self, thing_id, state=None, since=None, until=None):
-        """Get states for the thing with a given ID. First call self._get() to
-        retrieve from the API the maximum numbers of states possible since last
-        retrieval. Add the new states to the local database. Then return from
-        the local database states matching given criteria.
+        """Get states for the thing with a given ID. If the last retrieval is
+        stale, first call self.sync_states() to retrieve from the API all states
+        since the last polled one, and add them to the local database. Then
+        return from the local database states matching given criteria.
 
         Args:
             thing_id (str): Limit to the thing with this ID.
@@ -347,60 +775,352 @@ class SmartThings(object):
             since (Optional[datetime]): Limit to results on or after this time.
             until (Optional[datetime]): Limit to results before this time.
         Returns:
-            Collection of states.
+            Iterable of states sorted by date.
 
         """
 
-        def _params(kind):
-            """Build appropriate params. `kind` can be `api` or `db`."""
+        # Fetch and store states newer than the last polled one.
+        params = {
+            "function": "states",
+            "thing_id": thing_id,
+        }
+        if state is not None:
+            params["state"] = state
+        if state is not None and self._due(params) is not None:
+            self.sync_states(
+                thing_id,
+                state,
+                since=self.last_polled(thing_id, state),
+            )
+        # Get final data from database.
+        return storage.store(db).find(thing_id, state, since, until)
+
+    def batch_states(self, series):
+        """Like states() for many series at once, without returning states.
+        Stale series are fetched BATCH_SERIES at a time with the SmartApp's
+        `batchStates` function, instead of one request per series. Series
+        with more than BATCH_MAX new states are paged with sync_states().
+
+        Args:
+            series (list): `(thing_id, state)` tuples.
+        Returns:
+            Dictionary with numbers of stale `series`, `requests` made and
+            `inserted` states.
+
+        """
+        due = []
+        for thing_id, state in series:
             params = {
+                "function": "states",
                 "thing_id": thing_id,
+                "state":    state,
             }
-            if state is not None:
-                params["state"] = state
-            if kind is "api":
-                params["function"] = "states"
-            if kind is "db":
-                if since is not None:
-                    if until is not None:
-                        params["date"] = { "$gte": since, "$lt": until }
-                    else:
-                        params["date"] = { "$gte": since }
-                else:
-                    if until is not None:
-                        params["date"] = { "$lt": until }
-            return params
-
-        # Make request and store any returned data.
-        response = self._get(_params(kind="api"))
-        if response is not None:
-            data = [x for x in response.json() if x is not None]
-            inserted_count = 0
-            for item in data:
-                if not isinstance(item, dict):
-                    # Sometimes API returns empty items.
-                    break
-                item["thing_id"]  = thing_id
-                # Convert string date to Python date.
-                item["date"]      = datetime.strptime(item["date"],'%Y-%m-%dT%H:%M:%SZ')
-                # Insert retrieved things into database, overwriting any duplicates.
-                result = db.states.replace_one(
+            if self._due(params) is None:
+                continue
+            due.append((thing_id, state, self.last_polled(thing_id, state)))
+        stats = {"series": len(due), "requests": 0, "inserted": 0}
+        for batch in storage.batches(due, BATCH_SERIES):
+            failed = set()
+            since = dict(((t, s), d) for t, s, d in batch)
+            params = {
+                "function": "batchStates",
+                "max":      BATCH_MAX,
+                "series":   json.dumps([
                     {
-                        "thing_id": thing_id,
-                        "state":    state,
-                        "date":     item["date"],
-                    },
-                    item,
-                    upsert=True,
+                        "thing_id": t,
+                        "state":    s,
+                        "since":    seconds(d) if d is not None else None,
+                    }
+                    for t, s, d in batch
+                ]),
+            }
+            response = self._request(params, stream=True)
+            stats["requests"] += 1
+            if response.status_code != 200:
+                response.close()
+                log.error(
+                    "batch_states: {0} series returned HTTP {1}"
+                    .format(len(batch), response.status_code)
                 )
-                if result.upserted_id:
-                    inserted_count += 1
-            log.debug(
-                "states: Saved {0} states: {1} new, {2} replaced."
-                .format(len(data), inserted_count, len(data) - inserted_count)
-            )
-        # Get final data from database.
-        return db.states.find(_params(kind="db"))
+                continue
+            for group in iter_items(response):
+                if not isinstance(group, dict):
+                    continue
+                key = (group["thing_id"], group["state"])
+                if key not in since:
+                    continue
+                states = group.get("states") or []
+                stats["inserted"] += self._save_states(key[0], key[1], states)
+                dates = [
+                    x["date"] for x in states
+                    if isinstance(x, dict) and isinstance(x["date"], datetime)
+                ]
+                if len(states) >= BATCH_MAX:
+                    # Newest states come first; page back to the last polled.
+                    paged = self.sync_states(
+                        key[0],
+                        key[1],
+                        since=since[key],
+                        until=min(dates),
+                    )
+                    stats["inserted"] += paged["inserted"]
+                    if paged["failed"]:
+                        failed.add(key)
+                        continue
+                if dates:
+                    self._set_polled(key[0], key[1], max(dates))
+            for thing_id, state, last in batch:
+                if (thing_id, state) in failed:
+                    # Stays due, so the gap is fetched on the next poll.
+                    continue
+                self._set_query_time({
+                    "function": "states",
+                    "thing_id": thing_id,
+                    "state":    state,
+                })
+        if stats["series"] and not stats["inserted"]:
+            # Nothing new, but pages still show when data was refreshed, so
+            # write the call times before pages are recomputed.
+            calls.flush()
+            self._touch()
+        log.debug("batch_states: {0}".format(stats))
+        return stats
+
+    def sync_states(self, thing_id, state, since=None, until=None, progress=None):
+        """Fetch states from the API and store them, paging through responses
+        that hit the PAGE_SIZE cap. The SmartApp returns the newest states
+        first, so after a full page the window is narrowed to end at the
+        oldest state returned, and fetched again until a page comes back short.
+
+        Args:
+            thing_id (str): Thing to fetch states of.
+            state (str): Type of state to fetch.
+            since (Optional[datetime]): Start of window. If None, the SmartApp
+                default of 7 days ago is used.
+            until (Optional[datetime]): End of window. If None, now.
+            progress (Optional[callable]): Called with the new end of the
+                window after each full page, to checkpoint progress.
+        If the window reaches now and is fetched without failures, the call
+        time is recorded and the newest state fetched becomes the series'
+        polled high-water mark.
+        Returns:
+            Dictionary with numbers of `rows` received, `inserted` states and
+            `pages` fetched, whether the first page was `full`, and whether
+            a request `failed` before the window was fully fetched, in which
+            case the window must be fetched again.
+
+        """
+        stats = {
+            "rows":     0,
+            "inserted": 0,
+            "pages":    0,
+            "full":     False,
+            "failed":   False,
+        }
+        # Only a window reaching now moves the polled high-water mark.
+        polling = until is None
+        newest = None
+        while True:
+            params = {
+                "function": "states",
+                "thing_id": thing_id,
+                "state":    state,
+                "max":      PAGE_SIZE,
+            }
+            if since is not None:
+                params["since"] = seconds(since)
+            if until is not None:
+                params["until"] = seconds(until)
+            response = self._request(params, stream=True)
+            if response.status_code != 200:
+                response.close()
+                log.error(
+                    "sync_states: {0} {1} returned HTTP {2}"
+                    .format(thing_id, state, response.status_code)
+                )
+                stats["failed"] = True
+                break
+            count = 0
+            oldest = None
+            items = (x for x in iter_items(response) if isinstance(x, dict))
+            for batch in storage.batches(items, BATCH_SIZE):
+                count += len(batch)
+                # API dates sort correctly as strings.
+                batch_oldest = min(x["date"] for x in batch)
+                if oldest is None or batch_oldest < oldest:
+                    oldest = batch_oldest
+                batch_newest = max(x["date"] for x in batch)
+                if newest is None or batch_newest > newest:
+                    newest = batch_newest
+                stats["inserted"] += self._save_states(thing_id, state, batch)
+            stats["pages"] += 1
+            stats["rows"]  += count
+            if count < PAGE_SIZE:
+                break
+            if stats["pages"] == 1:
+                stats["full"] = True
+            oldest = datetime.strptime(oldest, '%Y-%m-%dT%H:%M:%SZ')
+            if until is not None and oldest >= until:
+                log.error(
+                    "sync_states: {0} {1} has over {2} states at {3}"
+                    .format(thing_id, state, PAGE_SIZE, oldest)
+                )
+                break
+            until = oldest
+            if progress is not None:
+                progress(until)
+        if polling and not stats["failed"]:
+            self._set_query_time({
+                "function": "states",
+                "thing_id": thing_id,
+                "state":    state,
+            })
+            if newest is not None:
+                self._set_polled(
+                    thing_id,
+                    state,
+                    datetime.strptime(newest, '%Y-%m-%dT%H:%M:%SZ'),
+                )
+        log.debug(
+            "sync_states: {0} {1}: {2}"
+            .format(thing_id, state, stats)
+        )
+        return stats
+
+    def series(self, thing_id, state, since, until, points=rollups.MIN_POINTS):
+        """Get values of one state for charting. Like states(), first update
+        the local database from the API. Then return values from the coarsest
+        rollup that still has `points` buckets in the range, or raw states if
+        none does.
+
+        Args:
+            thing_id (str): Limit to the thing with this ID.
+            state (str): Limit to this type of state.
+            since (datetime): Limit to results on or after this time.
+            until (datetime): Limit to results before this time.
+            points (Optional[int]): Minimum number of points wanted.
+        Returns:
+            Iterable of dictionaries with `date` and `value` keys.
+
+        """
+        self.states(thing_id, state)
+        return rollups.series(db, thing_id, state, since, until, points)
+
+    def enable_push(self, url):
+        """Ask the SmartApp to subscribe to all attributes of the selected
+        things and POST their events to url, so they need not be polled.
+
+        Args:
+            url (Optional[str]): Address of the `/ingest/<shortcode>` route
+                of the web app, or None to stop pushing.
+        Returns:
+            True if the SmartApp accepted the request.
+
+        """
+        params = {
+            "function": "push",
+            "url":      url or "",
+            "key":      push_key(self.token()) if url else "",
+        }
+        response = self._request(params)
+        response.close()
+        log.debug(
+            "enable_push: {0} returned HTTP {1}"
+            .format(url, response.status_code)
+        )
+        return response.status_code == 200
+
+    def save_pushed(self, events):
+        """Store states pushed by the SmartApp. Pushed and polled states are
+        deduplicated by the storage engine, so polling the same period again
+        is harmless. Events of things not belonging to this account are
+        dropped.
+
+        Args:
+            events (list): Dictionaries with `thing_id`, `state`, `date` and
+                `value` keys, dates formatted as returned by the API.
+        Returns:
+            Number of states that were new to the database.
+
+        """
+        known = set(
+            x["id"] for x in
+            db.things.find({"token": self.token()}, {"id": True})
+        )
+        groups = {}
+        for item in events:
+            if not isinstance(item, dict) \
+                    or not isinstance(item.get("thing_id"), basestring) \
+                    or not isinstance(item.get("state"), basestring) \
+                    or item["thing_id"] not in known:
+                continue
+            try:
+                # Check date now, so one bad event cannot fail a batch.
+                datetime.strptime(item["date"], '%Y-%m-%dT%H:%M:%SZ')
+                key = (item["thing_id"], item["state"])
+                value = item["value"]
+            except (KeyError, TypeError, ValueError):
+                continue
+            groups.setdefault(key, []).append({
+                "state": key[1],
+                "date":  item["date"],
+                "value": value,
+            })
+        inserted = 0
+        for (thing_id, state), items in groups.items():
+            inserted += self._save_states(thing_id, state, items)
+        return inserted
+
+    def _save_states(self, thing_id, state, data):
+        """Store states returned by the API in one unordered batch using the
+        configured storage engine, which skips duplicates. New states are added
+        to rollups and series summaries.
+
+        Args:
+            thing_id (str): ID of the thing the states belong to.
+            state (Optional[str]): Type of state requested.
+            data (list): State items as decoded from the API response.
+
+        Returns:
+            Number of states that were new to the database.
+
+        """
+        documents = []
+        for item in data:
+            if not isinstance(item, dict):
+                # Sometimes API returns empty items.
+                break
+            item["thing_id"]  = thing_id
+            item.setdefault("state", state)
+            # Convert string date to Python date.
+            item["date"]      = datetime.strptime(item["date"],'%Y-%m-%dT%H:%M:%SZ')
+            documents.append(item)
+        inserted = documents
+        if documents:
+            with metrics.timer(metrics.DB_SECONDS, collection="states"):
+                inserted = storage.store(db).insert(documents)
+                rollups.update(db, inserted)
+                summaries.update(db, inserted)
+                if inserted:
+                    self._touch()
+        metrics.INGEST_ROWS.inc(len(documents), collection="states")
+        metrics.INGEST_WRITES.inc(len(inserted), collection="states")
+        log.debug(
+            "states: Saved {0} states: {1} new, {2} duplicate."
+            .format(len(documents), len(inserted), len(documents) - len(inserted))
+        )
+        return len(inserted)
+
+
+def fingerprint(thing):
+    """Return hash of the content of a thing as returned by the API, such as
+    its label and capabilities, to tell whether it changed.
+    """
+    content = dict(
+        (k, v) for k, v in thing.items()
+        if k not in ("_id", "token", "active", "kinds", "fingerprint")
+    )
+    return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
 
 
 def attributes(thing):
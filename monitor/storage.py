@@ -0,0 +1,485 @@
+"""Storage engines for raw states. ENGINE selects the layout used by
+SmartThings and all raw state reads:
+
+    rows: One document per state in `states`, deduplicated by the unique
+        `(thing_id, state, date)` index.
+    buckets: One document per series per hour in `state_buckets`, holding
+        that hour's readings in an array. Far fewer and smaller index
+        entries than `rows` for chatty devices.
+
+Existing `rows` data is copied to `buckets` with `tasks.py migrate`, which can
+be rerun safely if interrupted.
+
+store() returns the engine behind a TieredStore, which also reads states moved
+to the cold archive of `archive.py` by `tasks.py compact`.
+
+"""
+import logging
+log = logging.getLogger(__name__)
+log.debug("storage.py loaded")
+
+from datetime import timedelta
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+import archive
+import metrics
+
+
+ENGINE = "rows" # layout of raw states, `rows` or `buckets`
+DUPLICATE_KEY = 11000 # MongoDB error code for unique index violations
+
+
+def batches(items, size):
+    """Group an iterable into lists of at most `size` items."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def bucket(date, size):
+    """Return start of the bucket of given size containing date.
+
+    Args:
+        date (datetime): Time of a state.
+        size (int): Bucket size in seconds.
+    Returns:
+        datetime of the start of the bucket.
+
+    """
+    seconds = int((date - archive.EPOCH).total_seconds())
+    return archive.EPOCH + timedelta(seconds=seconds - seconds % size)
+
+
+def _date_filter(since, until):
+    """Return query on dates for optional range, or None if unbounded."""
+    date = {}
+    if since is not None:
+        date["$gte"] = since
+    if until is not None:
+        date["$lt"] = until
+    return date or None
+
+
+def _rejected(error):
+    """Return indexes of operations rejected as duplicates by a bulk write,
+    re-raising the error if anything else failed.
+    """
+    errors = error.details["writeErrors"]
+    if any(x["code"] != DUPLICATE_KEY for x in errors):
+        raise error
+    return set(x["index"] for x in errors)
+
+
+class RowStore(object):
+    """One document per state in the `states` collection."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def insert(self, documents):
+        """Insert states, skipping any already stored.
+
+        Args:
+            documents (list): States with `thing_id`, `state`, `date` and
+                `value` keys.
+        Returns:
+            List of the states that were new.
+
+        """
+        if not documents:
+            return []
+        try:
+            self.db.states.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            rejected = _rejected(e)
+            return [x for i, x in enumerate(documents) if i not in rejected]
+        return documents
+
+    def find(self, thing_id, state=None, since=None, until=None, batch_size=1000):
+        """Get states of a thing sorted by date.
+
+        Args:
+            thing_id (str): Limit to the thing with this ID.
+            state (Optional[str]): Limit to this type of state.
+            since (Optional[datetime]): Limit to states on or after this time.
+            until (Optional[datetime]): Limit to states before this time.
+            batch_size (Optional[int]): States read from the database at once.
+        Returns:
+            Iterable of states with `thing_id`, `state`, `date` and `value`.
+
+        """
+        params = {
+            "thing_id": thing_id,
+        }
+        if state is not None:
+            params["state"] = state
+        date = _date_filter(since, until)
+        if date:
+            params["date"] = date
+        return self.db.states.find(
+            params,
+            {"_id": False},
+        ).sort("date", ASCENDING).batch_size(batch_size)
+
+    def scan(self, batch_size=1000):
+        """Iterate over all stored states in no particular order."""
+        return self.db.states.find({}, {"_id": False}).batch_size(batch_size)
+
+    def delete(self, thing_id, state, until):
+        """Delete states of a series before a time.
+
+        Returns:
+            Number of states deleted.
+
+        """
+        return self.db.states.delete_many({
+            "thing_id": thing_id,
+            "state":    state,
+            "date":     {"$lt": until},
+        }).deleted_count
+
+    def date_range(self, thing_id, state=None):
+        """Get dates of first and last stored states of a thing.
+
+        Returns:
+            Dictionary with `min` and `max` keys, or None if none stored.
+
+        """
+        params = {
+            "thing_id": thing_id,
+        }
+        if state is not None:
+            params["state"] = state
+        dates = []
+        for direction in [ASCENDING, DESCENDING]:
+            documents = list(
+                self.db.states.find(params, {"date": True})
+                .sort("date", direction).limit(1)
+            )
+            if not documents:
+                return None
+            dates.append(documents[0]["date"])
+        return {
+            "min": dates[0],
+            "max": dates[1],
+        }
+
+
+class BucketStore(object):
+    """One document per series per BUCKET seconds in `state_buckets`, with
+    the readings of the bucket in a `readings` array of `date` and `value`.
+    """
+
+    BUCKET = 3600
+
+    def __init__(self, db):
+        self.db = db
+
+    def bucket(self, date):
+        """Return start of the bucket containing date."""
+        return bucket(date, self.BUCKET)
+
+    def _operation(self, item):
+        """Return update adding a state to its bucket unless already there.
+        If the bucket holds the date, the filter fails to match and the
+        upsert is rejected by the unique index as a duplicate.
+        """
+        return UpdateOne(
+            {
+                "thing_id":      item["thing_id"],
+                "state":         item["state"],
+                "bucket":        self.bucket(item["date"]),
+                "readings.date": {"$ne": item["date"]},
+            },
+            {
+                "$push": {"readings": {
+                    "date":  item["date"],
+                    "value": item["value"],
+                }},
+                "$inc": {"count": 1},
+            },
+            upsert=True,
+        )
+
+    def insert(self, documents):
+        """Insert states, skipping any already stored.
+
+        Args:
+            documents (list): States with `thing_id`, `state`, `date` and
+                `value` keys.
+        Returns:
+            List of the states that were new.
+
+        """
+        pending = list(documents)
+        inserted = []
+        # A rejected upsert is either a true duplicate or lost a race to
+        # create its bucket, so retry rejections once.
+        for attempt in range(2):
+            if not pending:
+                break
+            try:
+                self.db.state_buckets.bulk_write(
+                    [self._operation(x) for x in pending],
+                    ordered=False,
+                )
+                rejected = set()
+            except BulkWriteError as e:
+                rejected = _rejected(e)
+            inserted.extend(x for i, x in enumerate(pending) if i not in rejected)
+            pending = [x for i, x in enumerate(pending) if i in rejected]
+        return inserted
+
+    def _buckets(self, thing_id, state=None, since=None, until=None):
+        """Return query for buckets overlapping a date range."""
+        params = {
+            "thing_id": thing_id,
+        }
+        if state is not None:
+            params["state"] = state
+        date = _date_filter(
+            self.bucket(since) if since is not None else None,
+            until,
+        )
+        if date:
+            params["bucket"] = date
+        return params
+
+    def find(self, thing_id, state=None, since=None, until=None, batch_size=100):
+        """Get states of a thing sorted by date.
+
+        Args:
+            thing_id (str): Limit to the thing with this ID.
+            state (Optional[str]): Limit to this type of state.
+            since (Optional[datetime]): Limit to states on or after this time.
+            until (Optional[datetime]): Limit to states before this time.
+            batch_size (Optional[int]): Buckets read from the database at once.
+        Returns:
+            Iterable of states with `thing_id`, `state`, `date` and `value`.
+
+        """
+        cursor = self.db.state_buckets.find(
+            self._buckets(thing_id, state, since, until),
+            {"_id": False, "state": True, "bucket": True, "readings": True},
+        ).sort("bucket", ASCENDING).batch_size(batch_size)
+        if state is None:
+            # Buckets of different states may share hours; merge them.
+            groups = {}
+            for document in cursor:
+                groups.setdefault(document["bucket"], []).append(document)
+            documents = [
+                x for bucket in sorted(groups) for x in groups[bucket]
+            ]
+        else:
+            documents = cursor
+        return self._unpack(thing_id, documents, since, until)
+
+    def _unpack(self, thing_id, documents, since, until):
+        """Yield states of buckets sorted by date within each bucket."""
+        pending = []
+        current = None
+        for document in documents:
+            if document["bucket"] != current and pending:
+                for item in sorted(pending, key=lambda x: x["date"]):
+                    yield item
+                pending = []
+            current = document["bucket"]
+            for reading in document["readings"]:
+                if since is not None and reading["date"] < since:
+                    continue
+                if until is not None and reading["date"] >= until:
+                    continue
+                pending.append({
+                    "thing_id": thing_id,
+                    "state":    document["state"],
+                    "date":     reading["date"],
+                    "value":    reading["value"],
+                })
+        for item in sorted(pending, key=lambda x: x["date"]):
+            yield item
+
+    def scan(self, batch_size=100):
+        """Iterate over all stored states in no particular order."""
+        for document in self.db.state_buckets.find().batch_size(batch_size):
+            for reading in document["readings"]:
+                yield {
+                    "thing_id": document["thing_id"],
+                    "state":    document["state"],
+                    "date":     reading["date"],
+                    "value":    reading["value"],
+                }
+
+    def delete(self, thing_id, state, until):
+        """Delete states of a series before a time, which must be the start
+        of a bucket.
+
+        Returns:
+            Number of states deleted.
+
+        """
+        params = self._buckets(thing_id, state)
+        params["bucket"] = {"$lt": until}
+        count = 0
+        for document in self.db.state_buckets.find(params, {"count": True}):
+            count += document["count"]
+        self.db.state_buckets.delete_many(params)
+        return count
+
+    def date_range(self, thing_id, state=None):
+        """Get dates of first and last stored states of a thing.
+
+        Returns:
+            Dictionary with `min` and `max` keys, or None if none stored.
+
+        """
+        params = self._buckets(thing_id, state)
+        dates = []
+        for direction, pick in [(ASCENDING, min), (DESCENDING, max)]:
+            documents = list(
+                self.db.state_buckets.find(params, {"readings.date": True})
+                .sort("bucket", direction).limit(1)
+            )
+            if not documents:
+                return None
+            dates.append(pick(x["date"] for x in documents[0]["readings"]))
+        return {
+            "min": dates[0],
+            "max": dates[1],
+        }
+
+
+class TieredStore(object):
+    """States of a storage engine (`hot`) combined with those moved to the
+    cold archive (`cold`). States older than the archived range of their
+    series, such as from a late backfill, are not inserted, since archived
+    states are immutable. They are logged and counted in
+    metrics.ARCHIVE_DROPPED.
+    """
+
+    def __init__(self, hot, cold):
+        self.hot = hot
+        self.cold = cold
+
+    def insert(self, documents):
+        """Insert states, skipping any already stored or archived.
+
+        Args:
+            documents (list): States with `thing_id`, `state`, `date` and
+                `value` keys.
+        Returns:
+            List of the states that were new.
+
+        """
+        horizons = {}
+        fresh = []
+        dropped = {}
+        for item in documents:
+            key = (item["thing_id"], item["state"])
+            if key not in horizons:
+                horizons[key] = self.cold.horizon(*key)
+            if horizons[key] is None or item["date"] >= horizons[key]:
+                fresh.append(item)
+            else:
+                dropped[key] = dropped.get(key, 0) + 1
+        for key, count in dropped.items():
+            log.error(
+                "insert: Dropped {0} states of {1} {2} before archived {3}"
+                .format(count, key[0], key[1], horizons[key])
+            )
+            metrics.ARCHIVE_DROPPED.inc(count)
+        return self.hot.insert(fresh)
+
+    def find(self, thing_id, state=None, since=None, until=None):
+        """Get states of a thing sorted by date, archived ones included.
+
+        Args:
+            thing_id (str): Limit to the thing with this ID.
+            state (Optional[str]): Limit to this type of state.
+            since (Optional[datetime]): Limit to states on or after this time.
+            until (Optional[datetime]): Limit to states before this time.
+        Returns:
+            Iterable of states with `thing_id`, `state`, `date` and `value`.
+
+        """
+        hot = self.hot.find(thing_id, state, since, until)
+        if self.cold.empty(thing_id, state):
+            return hot
+        return archive.merge([self.cold.find(thing_id, state, since, until), hot])
+
+    def scan(self, batch_size=1000):
+        """Iterate over all stored and archived states in no particular
+        order."""
+        for item in self.cold.scan():
+            yield item
+        for item in self.hot.scan(batch_size):
+            yield item
+
+    def delete(self, thing_id, state, until):
+        """Delete stored states of a series before a time, leaving archived
+        states."""
+        return self.hot.delete(thing_id, state, until)
+
+    def date_range(self, thing_id, state=None):
+        """Get dates of first and last stored or archived states of a thing.
+
+        Returns:
+            Dictionary with `min` and `max` keys, or None if none stored.
+
+        """
+        ranges = [
+            x for x in [
+                self.cold.date_range(thing_id, state),
+                self.hot.date_range(thing_id, state),
+            ]
+            if x is not None
+        ]
+        if not ranges:
+            return None
+        return {
+            "min": min(x["min"] for x in ranges),
+            "max": max(x["max"] for x in ranges),
+        }
+
+
+ENGINES = {
+    "rows":    RowStore,
+    "buckets": BucketStore,
+}
+
+
+def store(db, engine=None):
+    """Get storage engine for raw states, combined with the cold archive.
+
+    Args:
+        db (pymongo.database.Database): Database holding the states.
+        engine (Optional[str]): Name of engine; defaults to ENGINE.
+    Returns:
+        TieredStore with a RowStore or BucketStore as `hot`.
+
+    """
+    return TieredStore(ENGINES[engine or ENGINE](db), archive.ColdStore())
+
+
+def migrate(db, batch_size=1000):
+    """Copy all states from the `rows` layout to the `buckets` layout. States
+    already copied are skipped, so an interrupted migration can be rerun.
+    The `states` collection is left in place to be dropped by hand.
+
+    Args:
+        db (pymongo.database.Database): Database holding the states.
+        batch_size (Optional[int]): States copied at once.
+    Returns:
+        Number of states copied.
+
+    """
+    target = BucketStore(db)
+    copied = 0
+    for batch in batches(RowStore(db).scan(batch_size), batch_size):
+        copied += len(target.insert(batch))
+    log.debug("migrate: Copied {0} states.".format(copied))
+    return copied
@@ -0,0 +1,170 @@
+"""Per series summaries of stored states. For every `(thing_id, state)` series,
+the `series` collection holds one document with the dates of the first and
+last stored states, the number of stored states and the last value. Summaries
+are updated by SmartThings._save_states() as new states are ingested, so the
+date range of a series can be read without scanning its states. A series
+without a summary, such as one stored before summaries existed, is summarized
+from all its stored states the first time new states are added. Summaries can
+be rebuilt from scratch with `tasks.py summaries`.
+
+"""
+import logging
+log = logging.getLogger(__name__)
+log.debug("summaries.py loaded")
+
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+import storage
+
+
+def _summarize(states):
+    """Return summaries of states keyed by `(thing_id, state)`."""
+    summaries = {}
+    for item in states:
+        key = (item["thing_id"], item["state"])
+        if key not in summaries:
+            summaries[key] = {
+                "first":      item["date"],
+                "last":       item["date"],
+                "count":      0,
+                "last_value": item["value"],
+            }
+        summary = summaries[key]
+        summary["count"] += 1
+        if item["date"] < summary["first"]:
+            summary["first"] = item["date"]
+        if item["date"] >= summary["last"]:
+            summary["last"] = item["date"]
+            summary["last_value"] = item["value"]
+    return summaries
+
+
+def _seed(db, store, thing_id, state):
+    """Create the missing summary of a series from all its stored states.
+
+    Returns:
+        True if the summary was created, or False if it was created
+        concurrently, in which case new states still need to be added.
+
+    """
+    summary = _summarize(store.find(thing_id, state)).get((thing_id, state))
+    if summary is None:
+        return False
+    try:
+        result = db.series.update_one(
+            {"thing_id": thing_id, "state": state},
+            {"$setOnInsert": summary},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        return False
+    log.debug("_seed: Summarized {0} {1}.".format(thing_id, state))
+    return result.upserted_id is not None
+
+
+def update(db, states, seed=True):
+    """Add newly ingested states to series summaries. States must not have
+    been added before, or they will be counted twice.
+
+    Args:
+        db (pymongo.database.Database): Database holding the summaries.
+        states (list): State documents with `thing_id`, `state`, `date` and
+            `value` keys, already stored.
+        seed (Optional[bool]): Summarize series lacking a summary from all
+            their stored states, which include the new ones.
+
+    """
+    summaries = _summarize(states)
+    if not summaries:
+        return
+    if seed:
+        existing = set(
+            (x["thing_id"], x["state"]) for x in db.series.find(
+                {"$or": [
+                    {"thing_id": thing_id, "state": state}
+                    for thing_id, state in summaries
+                ]},
+                {"_id": False, "thing_id": True, "state": True},
+            )
+        )
+        store = storage.store(db)
+        for key in list(summaries):
+            if key not in existing and _seed(db, store, key[0], key[1]):
+                del summaries[key]
+        if not summaries:
+            return
+    operations = []
+    for (thing_id, state), summary in summaries.items():
+        key = {
+            "thing_id": thing_id,
+            "state":    state,
+        }
+        operations.append(UpdateOne(
+            key,
+            {
+                "$min": {"first": summary["first"]},
+                "$max": {"last":  summary["last"]},
+                "$inc": {"count": summary["count"]},
+            },
+            upsert=True,
+        ))
+        # Only set last value if no newer state was saved concurrently.
+        operations.append(UpdateOne(
+            dict(key, last=summary["last"]),
+            {"$set": {"last_value": summary["last_value"]}},
+        ))
+    db.series.bulk_write(operations, ordered=True)
+    log.debug("update: Updated {0} series.".format(len(summaries)))
+
+
+def date_range(db, thing_id, state=None):
+    """Get date range of stored states from series summaries.
+
+    Args:
+        db (pymongo.database.Database): Database holding the summaries.
+        thing_id (str): Limit to the thing with this ID.
+        state (Optional[str]): Limit to this type of state.
+    Returns:
+        Dictionary with `min` and `max` keys, or None if no summary exists.
+
+    """
+    params = {
+        "thing_id": thing_id,
+    }
+    if state is not None:
+        params["state"] = state
+    result = None
+    for summary in db.series.find(params, {"first": True, "last": True}):
+        if result is None:
+            result = {"min": summary["first"], "max": summary["last"]}
+        else:
+            result["min"] = min(result["min"], summary["first"])
+            result["max"] = max(result["max"], summary["last"])
+    return result
+
+
+def rebuild(db, batch_size=1000):
+    """Recompute all series summaries from raw states of the configured
+    storage engine.
+
+    Args:
+        db (pymongo.database.Database): Database holding states and summaries.
+        batch_size (Optional[int]): Number of states read at once.
+
+    """
+    # Keep polled high-water marks, which are not derived from states.
+    polled = [
+        x for x in db.series.find(
+            {"polled_last": {"$exists": True}},
+            {"_id": False, "thing_id": True, "state": True, "polled_last": True},
+        )
+    ]
+    db.series.delete_many({})
+    states = storage.store(db).scan(batch_size)
+    for batch in storage.batches(states, batch_size):
+        update(db, batch, seed=False)
+    for item in polled:
+        db.series.update_one(
+            {"thing_id": item["thing_id"], "state": item["state"]},
+            {"$set": {"polled_last": item["polled_last"]}},
+        )
@@ -4,6 +4,32 @@ to be executed via crontab using a command like the following:
 
     0 */12 * * * cd /var/www/votecharlie.com/www/projects/monitor/monitor && ../bin/python -u tasks.py >> cron.log 2>&1
 
+Subcommands:
+    update (default): Apply indexes, then update states for all accounts.
+        Every subcommand but `indexes` refuses to run while an index in
+        indexes.REQUIRED could not be created.
+        `--accounts` and `--series` set how many accounts and how many series
+        per account are polled at once.
+    indexes: Apply declared indexes and report any drift, deleting any
+        duplicate documents that prevent a unique index from being created.
+    rollups: Rebuild all state rollups from raw states.
+    summaries: Rebuild all series summaries from raw states.
+    migrate: Copy states from the `rows` storage layout to `buckets`. Set
+        storage.ENGINE to "buckets" once done.
+    backfill: Fetch `--days` days of history for all series of all accounts,
+        resuming any unfinished backfill. `--accounts` and `--series` apply.
+    worker: Run forever, refreshing accounts queued by the web app when it
+        serves data in read only mode. `--accounts` and `--series` apply.
+    work: Run forever as one of any number of nodes sharing the polling of
+        all series through the work queue in the database. Polls `--accounts`
+        times `--series` series at once. See workqueue.py.
+    compact: Move raw states older than each account's retention period from
+        the database to the cold archive. See retention.py.
+    schedule: Run forever, polling each series at an interval adapted to how
+        often its states change, instead of running `update` from cron. Polls
+        `--accounts` times `--series` series at once, at most `--series` per
+        account.
+
 TODO:
     Decide whether to use `logging` instead of printing to stdout and consolidate
       `cron.log` that collects the printed statements and `app.log` that collects
@@ -12,8 +38,19 @@ TODO:
 Author: Charlie Gorichanaz <charlie@gorichanaz.com>
 
 """
+import argparse
 import logging
+import backfill
+import indexes
+import poller
+import retention
+import rollups
+import scheduler
 import smartthings
+import storage
+import summaries
+import workqueue
+import time
 
 
 logging.basicConfig(
@@ -25,7 +62,7 @@ log = logging.getLogger(__name__)
 log.debug("tasks.py loaded")
 
 
-def update_states(account_token, state="all"):
+def update_states(account_token, state="all", workers=1):
     """Update database with most recent state information.
 
     Arguments:
@@ -36,15 +73,62 @@ def update_states(account_token, state="all"):
             access. Otherwise if something specific like "temperature" is given,
             selects all devices under that category to which the user provided access,
             and then only retrieves the "temperature" state for those devices.
+        workers (Optional[int]): Number of batches of series to retrieve at
+            once.
     """
-    st = smartthings.SmartThings(account_token)
+    st = smartthings.client(account_token)
+    st.budget = poller.budget(account_token)
     things = st.things(state)
+    series = []
     for thing in things:
         if state is "all":
             for attribute in smartthings.attributes(thing):
-                states = st.states(thing["id"], attribute)
+                series.append((thing["id"], attribute))
         else:
-            states = st.states(thing["id"], state)
+            series.append((thing["id"], state))
+    poller.run(
+        st.batch_states,
+        list(storage.batches(series, smartthings.BATCH_SERIES)),
+        workers,
+    )
+
+
+def update_account(account_token, workers=1):
+    """Update all states and then temperature states for one account.
+
+    Arguments:
+        account_token (str): The access token for the account.
+        workers (Optional[int]): Number of series to retrieve at once.
+    """
+    update_states(account_token, workers=workers)
+    update_states(account_token, "temperature", workers=workers)
+
+
+def work_refreshes(account_workers, series_workers, interval=5):
+    """Refresh accounts queued by smartthings.request_refresh() forever.
+
+    Arguments:
+        account_workers (int): Number of accounts to refresh at once.
+        series_workers (int): Number of series to retrieve at once per account.
+        interval (Optional[int]): Seconds to wait when the queue is empty.
+    """
+    while True:
+        tokens = []
+        while len(tokens) < account_workers:
+            token = smartthings.next_refresh()
+            if token is None:
+                break
+            tokens.append(token)
+        if not tokens:
+            time.sleep(interval)
+            continue
+        log.debug("work_refreshes: refreshing {0} accounts".format(len(tokens)))
+        poller.run(
+            lambda token: update_account(token, series_workers),
+            tokens,
+            account_workers,
+        )
+        smartthings.calls.flush()
 
 
 def print_doc_counts():
@@ -53,9 +137,106 @@ def print_doc_counts():
         print "Collection {0} has {1} documents.".format(name, smartthings.db[name].count())
 
 
+def apply_indexes(remove_duplicates=False):
+    """Apply declared indexes and print what was created and any drift.
+
+    Returns:
+        True if every index ingestion relies on exists.
+    """
+    report = indexes.ensure(smartthings.db, remove_duplicates)
+    for name in report["created"]:
+        print "Created index {0}.".format(name)
+    for name in report["failed"]:
+        print "Could not create index {0}; run `tasks.py indexes`.".format(name)
+    for name in report["conflicting"]:
+        print "Index {0} differs from its declaration.".format(name)
+    for name in report["extra"]:
+        print "Index {0} is not declared.".format(name)
+    return not set(report["failed"]) & set(indexes.REQUIRED)
+
+
 if __name__ == "__main__":
-    print_doc_counts()
-    for account in smartthings.accounts():
-        update_states(account["token"])
-        update_states(account["token"], "temperature")
-    print_doc_counts()
+    parser = argparse.ArgumentParser(description="Monitor background tasks.")
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="update",
+        choices=[
+            "update",
+            "indexes",
+            "rollups",
+            "summaries",
+            "migrate",
+            "backfill",
+            "worker",
+            "schedule",
+            "compact",
+            "work",
+        ],
+    )
+    parser.add_argument(
+        "--accounts",
+        type=int,
+        default=poller.ACCOUNT_WORKERS,
+        help="number of accounts to poll at once",
+    )
+    parser.add_argument(
+        "--series",
+        type=int,
+        default=poller.SERIES_WORKERS,
+        help="number of series to poll at once per account",
+    )
+    parser.add_argument(
+        "--days",
+        type=int,
+        default=30,
+        help="days of history to backfill",
+    )
+    args = parser.parse_args()
+    if not apply_indexes(remove_duplicates=args.command == "indexes"):
+        if args.command != "indexes":
+            print "States may be duplicated; run `tasks.py indexes` first."
+            raise SystemExit(1)
+    if args.command == "update":
+        print_doc_counts()
+        poller.run(
+            lambda account: update_account(account["token"], args.series),
+            smartthings.accounts(),
+            args.accounts,
+        )
+        smartthings.calls.flush()
+        print_doc_counts()
+    elif args.command == "rollups":
+        rollups.rebuild(smartthings.db)
+        print_doc_counts()
+    elif args.command == "summaries":
+        summaries.rebuild(smartthings.db)
+        print_doc_counts()
+    elif args.command == "migrate":
+        print "Copied {0} states.".format(storage.migrate(smartthings.db))
+        print_doc_counts()
+    elif args.command == "backfill":
+        print_doc_counts()
+        poller.run(
+            lambda account: backfill.backfill(
+                account["token"],
+                args.days,
+                args.series,
+            ),
+            smartthings.accounts(),
+            args.accounts,
+        )
+        smartthings.calls.flush()
+        print_doc_counts()
+    elif args.command == "worker":
+        work_refreshes(args.accounts, args.series)
+    elif args.command == "schedule":
+        scheduler.Scheduler(args.accounts * args.series, args.series).run()
+    elif args.command == "compact":
+        print_doc_counts()
+        print "Archived {0} states.".format(
+            retention.compact(smartthings.db, smartthings.accounts())
+        )
+        print_doc_counts()
+    elif args.command == "work":
+        workqueue.Worker(smartthings.db, args.accounts * args.series).run()
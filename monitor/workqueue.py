@@ -0,0 +1,296 @@
+"""Work queue in MongoDB letting several poller nodes share the polling of all
+series, run with `tasks.py work` on each node. Every `(token, thing_id, state)`
+series is a job in the `jobs` collection with a due time. Nodes claim due jobs
+one at a time with an expiring lease, so each job is polled by one node at a
+time however many nodes run, and nodes take work as fast as they finish it.
+
+A node renews the leases of its running jobs every LEASE_SECONDS / 3 seconds.
+If a node dies, its leases expire and other nodes claim the jobs again. A
+node that loses a lease, such as after a long pause, cannot complete the job,
+since completing requires still holding the lease.
+
+Poll intervals adapt to each series like in `scheduler.py`, and each poll
+starts from the series' polled high-water mark, so a failed poll is retried
+without leaving a gap. Requests of each account draw on one
+poller.SharedBudget in the `budgets` collection, so all nodes together stay
+within the account's rate limit. Every node also adds jobs for new series,
+and deletes jobs of series whose things or accounts are gone, every
+DISCOVER_INTERVAL seconds, which is safe to do concurrently.
+
+Several local workers can be tried against the stand-in SmartApp of
+`bench.py` with its `--nodes` option.
+
+"""
+import logging
+log = logging.getLogger(__name__)
+log.debug("workqueue.py loaded")
+
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+import poller
+import scheduler
+import smartthings
+
+
+LEASE_SECONDS     = 300  # seconds a claimed job is reserved without renewal
+RETRY_SECONDS     = 300  # seconds before a failed job is due again
+IDLE_SECONDS      = 5    # seconds to wait when no job is due
+DISCOVER_INTERVAL = 3600 # seconds between scans for new series
+
+
+def node_id():
+    """Return an ID unique to this process."""
+    return "{0}-{1}-{2}".format(
+        socket.gethostname(),
+        os.getpid(),
+        uuid.uuid4().hex[:8],
+    )
+
+
+def add(db, token, thing_id, state):
+    """Add a job for a series, due now, unless it exists.
+
+    Returns:
+        True if the job was added.
+
+    """
+    try:
+        result = db.jobs.update_one(
+            {"token": token, "thing_id": thing_id, "state": state},
+            {"$setOnInsert": {
+                "due":      datetime.utcnow(),
+                "interval": scheduler.DEFAULT_INTERVAL,
+                "polled":   None,
+                "owner":    None,
+                "expires":  None,
+            }},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        return False # added concurrently by another node
+    return result.upserted_id is not None
+
+
+def discover(db):
+    """Add jobs for all series of all connected accounts, and delete jobs of
+    series whose things or accounts are gone.
+
+    Returns:
+        Number of jobs added.
+
+    """
+    added = 0
+    found = set()
+    failed = set()
+    for account in smartthings.accounts():
+        token = account["token"]
+        try:
+            st = smartthings.client(token)
+            st.budget = poller.shared_budget(db.budgets, token)
+            for thing in st.things("all"):
+                for attribute in smartthings.attributes(thing):
+                    found.add((token, thing["id"], attribute))
+                    added += add(db, token, thing["id"], attribute)
+        except Exception:
+            log.exception("discover: listing things failed")
+            # Keep the account's jobs rather than deleting them.
+            failed.add(token)
+    gone = [
+        x["_id"] for x in
+        db.jobs.find({}, {"token": True, "thing_id": True, "state": True})
+        if x["token"] not in failed
+        and (x["token"], x["thing_id"], x["state"]) not in found
+    ]
+    if gone:
+        # A node still polling one of them fails to complete it, as if
+        # its lease was lost.
+        db.jobs.delete_many({"_id": {"$in": gone}})
+    log.debug(
+        "discover: Added {0} jobs, deleted {1}.".format(added, len(gone))
+    )
+    return added
+
+
+def claim(db, node, lease=LEASE_SECONDS):
+    """Claim the job that has been due longest and is not leased.
+
+    Args:
+        db (pymongo.database.Database): Database holding the jobs.
+        node (str): ID of the claiming node.
+        lease (Optional[float]): Seconds to reserve the job for.
+    Returns:
+        Claimed job, or None if no job is due.
+
+    """
+    now = datetime.utcnow()
+    return db.jobs.find_one_and_update(
+        {
+            "due": {"$lte": now},
+            "$or": [
+                {"owner": None},
+                {"expires": {"$lt": now}}, # lease of a dead node
+            ],
+        },
+        {"$set": {
+            "owner":   node,
+            "expires": now + timedelta(seconds=lease),
+        }},
+        sort=[("due", ASCENDING)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def renew(db, job, node, lease=LEASE_SECONDS):
+    """Extend the lease of a claimed job.
+
+    Returns:
+        False if the lease was lost to another node.
+
+    """
+    result = db.jobs.update_one(
+        {"_id": job["_id"], "owner": node},
+        {"$set": {"expires": datetime.utcnow() + timedelta(seconds=lease)}},
+    )
+    return result.matched_count == 1
+
+
+def complete(db, job, node, due, **fields):
+    """Release a claimed job, setting when it is due next.
+
+    Args:
+        db (pymongo.database.Database): Database holding the jobs.
+        job (dict): Claimed job.
+        node (str): ID of the node holding the lease.
+        due (datetime): Time the job is due next.
+        **fields: Other fields of the job to set.
+    Returns:
+        False if the lease was lost, in which case nothing is changed.
+
+    """
+    fields.update({"due": due, "owner": None, "expires": None})
+    result = db.jobs.update_one(
+        {"_id": job["_id"], "owner": node},
+        {"$set": fields},
+    )
+    return result.matched_count == 1
+
+
+class Worker(object):
+    """Node claiming and polling jobs on a pool of threads."""
+
+    def __init__(self, db, threads=poller.ACCOUNT_WORKERS * poller.SERIES_WORKERS,
+                 lease=LEASE_SECONDS):
+        """Set up a node.
+
+        Args:
+            db (pymongo.database.Database): Database holding the jobs.
+            threads (Optional[int]): Jobs polled at once.
+            lease (Optional[float]): Seconds jobs are leased for.
+        """
+        self.db = db
+        self.node = node_id()
+        self._threads = threads
+        self._lease = lease
+        self._running = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.completed = 0
+
+    def _renew_forever(self):
+        """Renew leases of running jobs until stopped."""
+        while not self._stop.wait(self._lease / 3.0):
+            with self._lock:
+                jobs = self._running.values()
+            for job in jobs:
+                if not renew(self.db, job, self.node, self._lease):
+                    log.error(
+                        "_renew_forever: {0} lost lease of {1} {2}"
+                        .format(self.node, job["thing_id"], job["state"])
+                    )
+
+    def _work(self, stop_when_idle):
+        """Claim and poll jobs until stopped."""
+        while not self._stop.is_set():
+            job = claim(self.db, self.node, self._lease)
+            if job is None:
+                if stop_when_idle:
+                    return
+                self._stop.wait(IDLE_SECONDS)
+                continue
+            with self._lock:
+                self._running[job["_id"]] = job
+            try:
+                self._run(job)
+            finally:
+                with self._lock:
+                    del self._running[job["_id"]]
+
+    def _run(self, job):
+        """Poll one job and release it with its next due time."""
+        job, stats, started = scheduler.poll(
+            job,
+            poller.shared_budget(self.db.budgets, job["token"]),
+        )
+        if stats is None:
+            due = datetime.utcnow() + timedelta(seconds=RETRY_SECONDS)
+            complete(self.db, job, self.node, due)
+            return
+        elapsed = None
+        if job.get("polled") is not None:
+            elapsed = (started - job["polled"]).total_seconds() + scheduler.OVERLAP
+        interval = scheduler.next_interval(
+            job["interval"],
+            stats["rows"],
+            elapsed,
+            stats["full"],
+        )
+        if complete(
+                self.db,
+                job,
+                self.node,
+                started + timedelta(seconds=interval),
+                interval=interval,
+                polled=started):
+            with self._lock:
+                self.completed += 1
+
+    def run(self, stop_when_idle=False):
+        """Work until stopped, or until no job is due if `stop_when_idle`."""
+        if not stop_when_idle:
+            discover(self.db)
+        renewer = threading.Thread(target=self._renew_forever)
+        renewer.daemon = True
+        renewer.start()
+        threads = [
+            threading.Thread(target=self._work, args=(stop_when_idle,))
+            for i in range(self._threads)
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        discovered = time.time()
+        try:
+            while any(x.is_alive() for x in threads):
+                for thread in threads:
+                    thread.join(1)
+                if not stop_when_idle \
+                        and time.time() - discovered >= DISCOVER_INTERVAL:
+                    discover(self.db)
+                    discovered = time.time()
+        finally:
+            self._stop.set()
+        smartthings.calls.flush()
+        log.debug(
+            "run: {0} completed {1} jobs."
+            .format(self.node, self.completed)
+        )
+
+    def stop(self):
+        """Stop claiming jobs; running jobs finish first."""
+        self._stop.set()